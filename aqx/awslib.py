@@ -1,20 +1,42 @@
-import boto3
+import os
+import json
 import time
+import socket
+import hashlib
 import logging
+import threading
 import dataclasses
+from aqx.protocol import RUNTIME_DIR
 
 
 log = logging.getLogger(__name__)
 
+# ids per start/stop_instances call and per describe_instances filter
+API_BATCH_SIZE = 100
+WAIT_TIMEOUT = 600
+WAIT_INITIAL_DELAY = 2
+WAIT_MAX_DELAY = 15
+SSH_PROBE_TIMEOUT = 3
+SSH_PROBE_WORKERS = 16
+
 
 @dataclasses.dataclass
 class Options:
     aws_access_key_id: str = None
     aws_secret_access_key: str = None
     region_name: str = None
+    # seconds the instance inventory is reused from the disk cache, 0 disables it
+    inventory_ttl: float = 300
+
+
+# boto3's default session isn't thread-safe, so clients are created under a lock
+_api_lock = threading.Lock()
+_shared_ec2_instances = {}
 
 
 def get_default_api(service, options: Options = None):
+    import boto3
+
     kwargs = {}
     if options is not None:
         kwargs.update(
@@ -23,7 +45,23 @@ def get_default_api(service, options: Options = None):
             region_name=options.region_name,
         )
 
-    return boto3.client(service, **kwargs)
+    with _api_lock:
+        return boto3.client(service, **kwargs)
+
+
+def get_ec2_instances(options: Options) -> "EC2Instances":
+    """
+    :return: EC2Instances shared by everything that uses the same credentials
+        and region, so that they share one client and one inventory
+    """
+    key = dataclasses.astuple(options)
+    with _api_lock:
+        api = _shared_ec2_instances.get(key)
+    if api is None:
+        api = EC2Instances(options=options)
+        with _api_lock:
+            api = _shared_ec2_instances.setdefault(key, api)
+    return api
 
 
 @dataclasses.dataclass
@@ -36,71 +74,272 @@ class EC2Instance:
     ip_address: str = None
 
 
+class InventoryCache:
+    """
+    Instances of an account and region saved on disk, so that short-lived
+    processes don't describe the whole account each time they resolve a host.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    @classmethod
+    def for_options(cls, options: Options):
+        # the secret takes part in the key only hashed, it's never written out
+        key = hashlib.sha256(
+            "\0".join(
+                str(value)
+                for value in [
+                    options.aws_access_key_id,
+                    options.aws_secret_access_key,
+                    options.region_name,
+                ]
+            ).encode("utf-8")
+        ).hexdigest()[:16]
+        path = os.path.join(RUNTIME_DIR, f"ec2-inventory-{key}.json")
+        return cls(path, options.inventory_ttl)
+
+    def read(self):
+        """
+        :return: (time it was saved, list of EC2Instance, whether it's the whole
+            inventory or only the instances looked up so far)
+            or None if there's nothing fresh enough
+        """
+        if self.ttl <= 0:
+            return None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - data["saved_at"] > self.ttl:
+            return None
+        instances = [EC2Instance(**fields) for fields in data["instances"]]
+        return data["saved_at"], instances, data.get("complete", True)
+
+    def write(self, saved_at, instances, complete=True):
+        if self.ttl <= 0:
+            return
+        data = dict(
+            saved_at=saved_at,
+            instances=[dataclasses.asdict(inst) for inst in instances],
+            complete=complete,
+        )
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
 class EC2Instances:
-    def __init__(self, api=None, options: Options = None):
+    def __init__(self, api=None, options: Options = None, cache: InventoryCache = None):
         if options is None:
             options = Options()
         self.api = api or get_default_api("ec2", options)
-        self._cache = None
+        self.inventory = cache or InventoryCache.for_options(options)
+        # guards the in-memory inventory, so that concurrent lookups wait
+        # for one describe call instead of making their own
+        self._lock = threading.RLock()
+        self._set_cache(None, None)
 
     def create(self, name, instance_type, ssh_key_id):
         raise NotImplementedError
 
-    def _load(self, instance_ids=None):
+    def _load(self, filters=None):
+        """
+        :param filters: describe_instances Filters, everything if None
+        """
         kwargs = {}
-        if instance_ids is not None:
-            kwargs["InstanceIds"] = instance_ids
-        instances_data = self.api.describe_instances(**kwargs)
+        if filters is not None:
+            kwargs["Filters"] = filters
         result = []
-        for item in instances_data["Reservations"]:
-            inst = item["Instances"][0]
-            name = None
-            for tag in inst["Tags"]:
-                if tag["Key"] == "Name":
-                    name = tag["Value"]
-                    break
-            inst_obj = EC2Instance(
-                id=inst["InstanceId"],
-                name=name,
-                type=inst["InstanceType"],
-                state=inst["State"]["Name"],
-                key_name=inst["KeyName"],
-            )
-            if inst_obj.state == "running":
-                inst_obj.ip_address = inst["PublicIpAddress"]
-            result.append(inst_obj)
+        paginator = self.api.get_paginator("describe_instances")
+        for page in paginator.paginate(**kwargs):
+            for reservation in page["Reservations"]:
+                for inst in reservation["Instances"]:
+                    result.append(self._make_instance(inst))
         log.debug("found instances on AWS: %s", result)
         return result
 
+    @staticmethod
+    def _make_instance(data) -> EC2Instance:
+        name = None
+        for tag in data.get("Tags", ()):
+            if tag["Key"] == "Name":
+                name = tag["Value"]
+                break
+        inst = EC2Instance(
+            id=data["InstanceId"],
+            name=name,
+            type=data["InstanceType"],
+            state=data["State"]["Name"],
+            key_name=data.get("KeyName"),
+        )
+        if inst.state == "running":
+            inst.ip_address = data.get("PublicIpAddress")
+        return inst
+
     def load(self):
-        self._cache = self._load()
+        with self._lock:
+            loaded_at = time.time()
+            self._set_cache(loaded_at, self._load())
+            self.inventory.write(loaded_at, self._cache)
 
-    def list(self):
+    def invalidate(self):
+        """
+        Forgets the inventory both in memory and on disk.
+        """
+        with self._lock:
+            self._set_cache(None, None)
+            self.inventory.invalidate()
+
+    def _set_cache(self, cache_time, instances, complete=True):
+        self._cache_time = cache_time
+        self._cache = instances
+        # lookups by name or id only describe those instances, and the inventory
+        # they make up is good for more lookups but not for list()
+        self._complete = complete
+        self._by_id, self._by_name = _index(instances or ())
+
+    def _ensure_loaded(self):
+        self._drop_expired()
         if self._cache is None:
+            self._read_inventory()
+        if self._cache is None or not self._complete:
             self.load()
-        return self._cache[:]
 
-    def get_by(self, *, name=None, id=None) -> EC2Instance:
+    def _drop_expired(self):
+        # one instance serves the whole process, e.g. the daemon, so the TTL
+        # applies to the inventory in memory as well as on disk
+        if self._cache is not None:
+            if time.time() - self._cache_time > self.inventory.ttl:
+                self._set_cache(None, None)
+
+    def _read_inventory(self):
+        saved = self.inventory.read()
+        if saved is not None:
+            self._set_cache(*saved)
+
+    def _refresh(self, *, names=(), ids=()):
+        """
+        Re-describes only the given instances and merges them into the inventory.
+        :return: list of the found instances
+        """
+        with self._lock:
+            return self._refresh_locked(names, ids)
+
+    def _refresh_locked(self, names, ids):
+        found = []
+        for key, values in [("instance-id", ids), ("tag:Name", names)]:
+            for batch in _batches(list(values), API_BATCH_SIZE):
+                found += self._load(filters=[dict(Name=key, Values=batch)])
         if self._cache is None:
-            self.load()
-        for inst in self._cache:
-            if name is not None and name == inst.name:
-                return inst
-            if id is not None and id == inst.id:
-                return inst
-        raise KeyError(name)
+            self._read_inventory()
+        if self._cache is None:
+            # a partial list must not pass for the whole inventory,
+            # but it's still good for looking these instances up again
+            self._set_cache(time.time(), found, complete=False)
+            self.inventory.write(self._cache_time, self._cache, complete=False)
+            return found
+        stale_ids = set(ids) | {inst.id for inst in found}
+        stale_names = set(names)
+        instances = [
+            inst
+            for inst in self._cache
+            if inst.id not in stale_ids and inst.name not in stale_names
+        ] + found
+        self._set_cache(self._cache_time, instances, self._complete)
+        # a partial refresh doesn't make the rest of the inventory any fresher
+        self.inventory.write(self._cache_time, self._cache, self._complete)
+        return found
+
+    def list(self):
+        with self._lock:
+            self._ensure_loaded()
+            return self._cache[:]
+
+    def get_by(self, *, name=None, id=None) -> EC2Instance:
+        if name is not None:
+            [inst] = self.get_many(names=[name])
+        else:
+            [inst] = self.get_many(ids=[id])
+        return inst
+
+    def get_many(self, *, names=(), ids=()):
+        """
+        Looks up instances by names and ids, refreshing all that are missing
+        or not running in the inventory with a single describe call.
+        :return: list of EC2Instance, names' ones first
+        :raise KeyError: if any isn't found
+        """
+        with self._lock:
+            self._drop_expired()
+            if self._cache is None:
+                self._read_inventory()
+            # with no inventory at all, only these are described rather than
+            # the whole account; a cached instance that wasn't running may have
+            # started since, with a new address, so ask AWS about it too
+            stale_names = [n for n in names if not self._is_fresh(name=n)]
+            stale_ids = [i for i in ids if not self._is_fresh(id=i)]
+            if stale_names or stale_ids:
+                self._refresh_locked(stale_names, stale_ids)
+            result = [self._find(name=n) for n in names]
+            result += [self._find(id=i) for i in ids]
+        missing = [key for key, inst in zip([*names, *ids], result) if inst is None]
+        if missing:
+            raise KeyError(", ".join(missing))
+        return result
+
+    def _is_fresh(self, *, name=None, id=None):
+        inst = self._find(name=name, id=id)
+        return inst is not None and inst.state == "running"
+
+    def _find(self, *, name=None, id=None):
+        if name is not None:
+            return self._by_name.get(name)
+        return self._by_id.get(id)
 
     def run(self, instance, wait=False):
-        inst_id = self._get_instance_id(instance)
-        self.api.start_instances(InstanceIds=[inst_id])
-        if wait:
-            self._wait_until_state(inst_id, "running")
+        self.run_many([instance], wait=wait)
 
     def stop(self, instance, wait=False):
-        inst_id = self._get_instance_id(instance)
-        self.api.stop_instances(InstanceIds=[inst_id])
+        self.stop_many([instance], wait=wait)
+
+    def run_many(self, instances, wait=False, wait_ssh=False, on_ready=None):
+        """
+        Starts instances in batched API calls.
+        :param wait: return only when all of them are running
+        :param wait_ssh: moreover, wait until their SSH ports accept connections
+        :param on_ready: called with each EC2Instance as soon as it's ready,
+            while the others are still being waited for
+        :return: list of EC2Instance in their refreshed state
+        """
+        ids = [self._get_instance_id(instance) for instance in instances]
+        for batch in _batches(ids, API_BATCH_SIZE):
+            self.api.start_instances(InstanceIds=batch)
+        if wait or wait_ssh:
+            return self._wait_until_state(ids, "running", wait_ssh, on_ready)
+        return self._refresh(ids=ids)
+
+    def stop_many(self, instances, wait=False, on_ready=None):
+        """
+        Stops instances in batched API calls, see run_many.
+        """
+        ids = [self._get_instance_id(instance) for instance in instances]
+        for batch in _batches(ids, API_BATCH_SIZE):
+            self.api.stop_instances(InstanceIds=batch)
         if wait:
-            self._wait_until_state(inst_id, "stopped")
+            return self._wait_until_state(ids, "stopped", False, on_ready)
+        return self._refresh(ids=ids)
 
     def delete(self, instance):
         raise NotImplementedError
@@ -126,11 +365,90 @@ class EC2Instances:
             return self.get_by(name=instance).id
         raise TypeError(type(instance))
 
-    def _wait_until_state(self, instance_id, state, timeout=60):
+    def _wait_until_state(
+        self, instance_ids, state, wait_ssh, on_ready, timeout=WAIT_TIMEOUT
+    ):
+        """
+        Polls all still pending instances with one describe call (per batch),
+        backing off between polls; SSH ports are probed concurrently.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
         deadline_time = time.time() + timeout
-        while time.time() < deadline_time:
-            [inst] = self._load([instance_id])
-            if inst.state == state:
-                return
-            time.sleep(5)
-        raise Exception(f"could not wait for state {state} of instance {instance_id}")
+        delay = WAIT_INITIAL_DELAY
+        pending = set(instance_ids)
+        ready = {}
+        with ThreadPoolExecutor(max_workers=SSH_PROBE_WORKERS) as executor:
+            while pending:
+                in_state = []
+                for inst in self._refresh(ids=sorted(pending)):
+                    if inst.state == state:
+                        in_state.append(inst)
+                    elif inst.state in _UNREACHABLE_STATES[state]:
+                        raise Exception(
+                            f"instance {inst.id} went {inst.state} "
+                            f"while waiting for it to be {state}"
+                        )
+                if wait_ssh:
+                    reachable = executor.map(
+                        lambda inst: _is_port_open(inst.ip_address, 22), in_state
+                    )
+                    in_state = [inst for inst, ok in zip(in_state, reachable) if ok]
+                for inst in in_state:
+                    pending.discard(inst.id)
+                    ready[inst.id] = inst
+                    if on_ready is not None:
+                        on_ready(inst)
+                if not pending:
+                    break
+                if time.time() + delay > deadline_time:
+                    raise Exception(
+                        f"could not wait for state {state} of instances "
+                        + ", ".join(sorted(pending))
+                    )
+                time.sleep(delay)
+                delay = min(delay * 1.5, WAIT_MAX_DELAY)
+        return [ready[inst_id] for inst_id in instance_ids]
+
+
+# states an instance never leaves; anything else may still be the previous state
+# as describe_instances lags behind start/stop_instances
+_UNREACHABLE_STATES = {
+    "running": {"shutting-down", "terminated"},
+    "stopped": {"shutting-down", "terminated"},
+}
+
+
+def _index(instances):
+    """
+    :return: dicts of the instances by id and by name
+    """
+    by_id = {}
+    by_name = {}
+    for inst in instances:
+        by_id[inst.id] = inst
+        if inst.name is None:
+            continue
+        # names aren't unique, e.g. a terminated instance may linger
+        # with the name of its replacement; prefer the running one
+        same_name = by_name.get(inst.name)
+        if same_name is None or (
+            inst.state == "running" and same_name.state != "running"
+        ):
+            by_name[inst.name] = inst
+    return by_id, by_name
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def _is_port_open(address, port):
+    if address is None:
+        return False
+    try:
+        with socket.create_connection((address, port), timeout=SSH_PROBE_TIMEOUT):
+            return True
+    except OSError:
+        return False
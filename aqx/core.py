@@ -1,9 +1,14 @@
 import configparser
+import collections
+import contextlib
+import itertools
 import threading
-import socket
+import os
+import sys
 import logging
 import time
 import traceback
+from concurrent.futures import wait, FIRST_COMPLETED
 from concurrent.futures.thread import ThreadPoolExecutor
 from aqx import hostlib
 
@@ -12,9 +17,12 @@ log = logging.getLogger(__name__)
 
 
 class AppService:
-    def __init__(self, ini_file):
+    def __init__(self, ini_file, ssh_pool=None, session_limit=None):
+        self.client = current_client()
         self._cp = configparser.ConfigParser()
-        self._cp.read([ini_file])
+        self._cp.read([self.client.path(ini_file)])
+        self.ssh_pool = ssh_pool
+        self.session_limit = session_limit
 
     def maybe_resolve_host_alias(self, server_name):
         if server_name is None:
@@ -28,52 +36,384 @@ class AppService:
     def get_host(self, server_name):
         return hostlib.Host.from_configparser(self._cp, server_name)
 
+    def get_hosts(self, server_names):
+        """
+        Like get_host for each name, resolving their addresses up front
+        in parallel; aliases are resolved too.
+        """
+        hosts = [
+            self.get_host(self.maybe_resolve_host_alias(name)) for name in server_names
+        ]
+        hostlib.prefetch_addresses(hosts)
+        return hosts
+
+    def make_ssh_connection(self, server_name):
+        return self.get_host(server_name).make_ssh_connection(pool=self.ssh_pool)
+
+    def session_slot(self):
+        """
+        :return: context manager to hold around each host's part of a command
+            that fans out to many hosts, see SessionLimit
+        """
+        if self.session_limit is None:
+            return contextlib.nullcontext()
+        return self.session_limit.slot(self.client.cancelled)
+
+
+class LocalClient:
+    """
+    Terminal of the user who runs the command. In a standalone process it's
+    this process' own terminal, the daemon substitutes it per request.
+    """
+
+    def __init__(self, cwd=None):
+        self.cwd = cwd or os.getcwd()
+        self.cancelled = threading.Event()
+
+    @property
+    def stdin(self):
+        return sys.stdin.buffer
+
+    @property
+    def stdout(self):
+        return sys.stdout
+
+    @property
+    def stderr(self):
+        return sys.stderr
+
+    def path(self, path):
+        return os.path.join(self.cwd, os.path.expanduser(path))
+
+    def execute(self, command):
+        return os.system(command)
+
+    def browse_url(self, url):
+        import webbrowser
+
+        webbrowser.open(url)
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+_thread_context = threading.local()
+
+
+def current_client() -> LocalClient:
+    client = getattr(_thread_context, "client", None)
+    if client is None:
+        client = LocalClient()
+    return client
+
+
+def set_current_client(client):
+    _thread_context.client = client
+
+
+def with_current_client(function):
+    """
+    :return: function that runs with the client of the calling thread,
+        to be passed to other threads
+    """
+    client = getattr(_thread_context, "client", None)
+
+    def wrapper(*args, **kwargs):
+        set_current_client(client)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            set_current_client(None)
+
+    return wrapper
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+class Scheduler:
+    """
+    Admits requests to run: at most max_running at once and at most max_per_host
+    of them touching the same host. The rest wait in a queue of at most max_queued
+    entries; the oldest request whose hosts have free capacity goes first,
+    so one busy host doesn't hold back requests to the others.
+    """
+
+    # how often a queued request checks whether its client has gone
+    CANCEL_POLL_INTERVAL = 0.5
+    # number of recent requests the wait time stats are computed over
+    WAIT_STATS_WINDOW = 1000
+
+    def __init__(self, max_running=8, max_per_host=2, max_queued=64):
+        self.max_running = max_running
+        self.max_per_host = max_per_host
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._queue = collections.OrderedDict()
+        self._ticket_ids = itertools.count()
+        self._n_running = 0
+        self._running_per_host = collections.Counter()
+        self._n_admitted = 0
+        self._n_rejected = 0
+        self._n_cancelled = 0
+        self._wait_times = collections.deque(maxlen=self.WAIT_STATS_WINDOW)
+
+    @contextlib.contextmanager
+    def slot(self, hosts=(), cancelled: threading.Event = None):
+        """
+        Blocks until the request may run and holds its place while in the block.
+        :param hosts: names of the hosts the request is going to connect to
+        :param cancelled: event that aborts the wait with RequestCancelled
+        :raise SchedulerBusy: if the queue is full
+        """
+        hosts = frozenset(hosts)
+        self._acquire(hosts, cancelled)
+        try:
+            yield
+        finally:
+            self._release(hosts)
+
+    def _acquire(self, hosts, cancelled):
+        ticket = next(self._ticket_ids)
+        enqueued_at = time.monotonic()
+        with self._cond:
+            if len(self._queue) >= self.max_queued:
+                self._n_rejected += 1
+                raise SchedulerBusy(
+                    f"{len(self._queue)} requests are already queued, try again later"
+                )
+            self._queue[ticket] = (hosts, enqueued_at)
+            try:
+                while self._next_admissible() != ticket:
+                    if cancelled is not None and cancelled.is_set():
+                        self._n_cancelled += 1
+                        raise RequestCancelled
+                    self._cond.wait(self.CANCEL_POLL_INTERVAL)
+            finally:
+                del self._queue[ticket]
+                # our place in the queue might have blocked someone behind us
+                self._cond.notify_all()
+            self._n_running += 1
+            self._running_per_host.update(hosts)
+            self._n_admitted += 1
+            self._wait_times.append(time.monotonic() - enqueued_at)
+
+    def _release(self, hosts):
+        with self._cond:
+            self._n_running -= 1
+            self._running_per_host.subtract(hosts)
+            self._running_per_host += collections.Counter()  # drops zero counts
+            self._cond.notify_all()
+
+    def _next_admissible(self):
+        if self._n_running >= self.max_running:
+            return None
+        # hosts wanted by older requests that are still waiting; a newer request
+        # mustn't take them, otherwise a request to many hosts could starve
+        reserved = set()
+        for ticket, (hosts, _) in self._queue.items():
+            if reserved.isdisjoint(hosts) and all(
+                self._running_per_host[h] < self.max_per_host for h in hosts
+            ):
+                return ticket
+            reserved.update(hosts)
+        return None
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            wait_times = sorted(self._wait_times)
+            queued_per_host = collections.Counter()
+            for hosts, _ in self._queue.values():
+                queued_per_host.update(hosts)
+            return dict(
+                running=self._n_running,
+                queued=len(self._queue),
+                oldest_queued_age=max(
+                    (now - t for _, t in self._queue.values()), default=0.0
+                ),
+                admitted=self._n_admitted,
+                rejected=self._n_rejected,
+                cancelled_in_queue=self._n_cancelled,
+                wait_avg=sum(wait_times) / len(wait_times) if wait_times else 0.0,
+                wait_p95=wait_times[int(len(wait_times) * 0.95)] if wait_times else 0.0,
+                wait_max=wait_times[-1] if wait_times else 0.0,
+                hosts={
+                    str(host): dict(
+                        running=self._running_per_host[host],
+                        queued=queued_per_host[host],
+                    )
+                    for host in set(self._running_per_host) | set(queued_per_host)
+                },
+            )
+
+
+class SessionLimit:
+    """
+    Caps the hosts being worked on at once by all commands together: a command
+    fanning out to many hosts holds a slot per host while it's busy with it.
+    A slot holder must not wait for anything that needs another slot.
+    """
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self._cond = threading.Condition()
+        self._n_active = 0
+        self._n_waiting = 0
+
+    @contextlib.contextmanager
+    def slot(self, cancelled: threading.Event = None):
+        """
+        :param cancelled: event that aborts the wait with RequestCancelled
+        """
+        with self._cond:
+            self._n_waiting += 1
+            try:
+                while self._n_active >= self.max_sessions:
+                    if cancelled is not None and cancelled.is_set():
+                        raise RequestCancelled
+                    self._cond.wait(Scheduler.CANCEL_POLL_INTERVAL)
+            finally:
+                self._n_waiting -= 1
+            self._n_active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._n_active -= 1
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return dict(
+                active=self._n_active,
+                waiting=self._n_waiting,
+                max_sessions=self.max_sessions,
+            )
+
 
 class ExecutionService:
-    def __init__(self):
-        self._executor = ThreadPoolExecutor()
-        self._lock = threading.Lock()
-        self._ssh_connections = {}
-        self._pinger_thread = threading.Thread(
-            target=_wrap_with_dumping_traceback(self._ping_worker), daemon=True
+    def __init__(
+        self,
+        ssh_max_per_host=4,
+        ssh_idle_timeout=600,
+        ping_interval=60,
+        ping_timeout=10,
+        scheduler: Scheduler = None,
+        max_sessions=None,
+    ):
+        """
+        :param max_sessions: hosts worked on at once by all commands together,
+            see SessionLimit; None leaves it to each command's own parallelism
+        """
+        self.scheduler = scheduler or Scheduler()
+        self.session_limit = (
+            None if max_sessions is None else SessionLimit(max_sessions)
         )
-        self._pinger_thread.start()
+        self._ssh_max_per_host = ssh_max_per_host
+        self._ssh_idle_timeout = ssh_idle_timeout
+        self._ping_interval = ping_interval
+        self._ping_timeout = ping_timeout
+        # the pool and its pinger thread are started on first use, most
+        # commands of a short-lived process never need them
+        self._lock = threading.Lock()
+        self._ping_executor = None
+        self._ssh_pool = None
+
+    @property
+    def ssh_pool(self):
+        with self._lock:
+            if self._ssh_pool is None:
+                from aqx import sshlib
+
+                self._ssh_pool = sshlib.SSHPool(
+                    max_per_host=self._ssh_max_per_host,
+                    idle_timeout=self._ssh_idle_timeout,
+                )
+                self._ping_executor = ThreadPoolExecutor(max_workers=8)
+                threading.Thread(
+                    target=_wrap_with_dumping_traceback(self._ping_worker),
+                    daemon=True,
+                ).start()
+            return self._ssh_pool
 
-    def async_call(self, function, *args, **kwargs):
+    def start(self):
         """
-        :return: Re-entrant blocking function that returns the result of call 
+        Starts everything upfront, for a long-lived process to serve
+        its first command as fast as the next ones.
         """
-        future = self._executor.submit(function, *args, **kwargs)
-        return future.result
+        return self.ssh_pool
 
-    def get_ssh_connection(self, server):
-        with self._lock:
-            return self._ssh_connections.pop(server)
+    def get_ssh_connection(self, host: hostlib.Host):
+        return host.make_ssh_connection(pool=self.ssh_pool)
+
+    def stats(self) -> dict:
+        return dict(
+            scheduler=self.scheduler.stats(),
+            sessions=self.session_limit.stats() if self.session_limit else None,
+            ssh_pool=self.ssh_pool.stats(),
+        )
 
-    def add_ssh_connection(self, server, ssh):
+    def shutdown(self):
         with self._lock:
-            self._ssh_connections[server] = ssh
+            if self._ssh_pool is not None:
+                self._ssh_pool.close()
+                self._ping_executor.shutdown(wait=False)
 
     def _ping_worker(self):
         while True:
-            with self._lock:
-                keys_and_conns = list(self._ssh_connections.items())
-            for server, ssh in keys_and_conns:
-                should_stop = False
-                with self._lock:
-                    if ssh.connected:
-                        wait_fn, stdout, stderr = ssh.cmd_stream("echo")
-                        try:
-                            stdout.read()
-                            wait_fn()
-                        except socket.error:
-                            log.info(f"Failed to ping to server: {server}, {ssh}")
-                            should_stop = True
-                            if self._ssh_connections.get(server) is ssh:
-                                self._ssh_connections.pop(server)
-                if should_stop:
-                    ssh.stop()
-            time.sleep(60)
+            time.sleep(self._ping_interval)
+            self.ssh_pool.evict_idle()
+            self.check_connections()
+
+    def check_connections(self):
+        """
+        Pings all idle pooled connections concurrently; the pool is not locked
+        meanwhile, so a hung host delays nothing but its own check.
+        Each ping gets its own deadline counted from when it has started;
+        pings still queued behind hung ones are put off to the next round.
+        """
+        connections = self.ssh_pool.idle_connections()
+        started_at = {}
+        last_progress = [time.monotonic()]
+
+        def ping(ssh):
+            started_at[id(ssh)] = last_progress[0] = time.monotonic()
+            return ssh.ping(self._ping_timeout)
+
+        futures = {self._ping_executor.submit(ping, ssh): ssh for ssh in connections}
+        deadline = self._ping_timeout * 2
+        pending = set(futures)
+        while pending:
+            done, pending = wait(
+                pending, timeout=self._ping_timeout, return_when=FIRST_COMPLETED
+            )
+            now = time.monotonic()
+            if done:
+                last_progress[0] = now
+            for future in done:
+                if future.cancelled():
+                    continue
+                try:
+                    latency = future.result()
+                except Exception as exc:
+                    self.ssh_pool.report_health(futures[future], error=exc)
+                else:
+                    self.ssh_pool.report_health(futures[future], latency=latency)
+            for future in list(pending):
+                ssh = futures[future]
+                if id(ssh) in started_at:
+                    if now - started_at[id(ssh)] > deadline:
+                        pending.discard(future)
+                        self.ssh_pool.report_health(
+                            ssh, error=TimeoutError("health check timed out")
+                        )
+                elif now - last_progress[0] > deadline and future.cancel():
+                    # all workers are stuck with hung hosts, this one
+                    # hasn't been checked at all, so it hasn't failed either
+                    pending.discard(future)
 
 
 def _wrap_with_dumping_traceback(function):
@@ -1,3 +1,4 @@
+import shlex
 import dataclasses
 import typing
 
@@ -20,14 +21,21 @@ class Host:
 
             from aqx.awslib import Options
 
+            instance_name = server_name[4:]
+            inst_ini_section = "server.aws." + instance_name
+
             options = Options(
                 aws_access_key_id=cp.get("aws.access", "access_token"),
                 aws_secret_access_key=cp.get("aws.access", "secret_token"),
-                region_name=cp.get("aws.access", "region"),
+                region_name=cp.get(
+                    inst_ini_section,
+                    "region",
+                    fallback=cp.get("aws.access", "region"),
+                ),
+                inventory_ttl=cp.getfloat(
+                    "aws.access", "inventory_ttl", fallback=Options.inventory_ttl
+                ),
             )
-
-            instance_name = server_name[4:]
-            inst_ini_section = "server.aws." + instance_name
             return cls(
                 name=server_name,
                 address=instance_name,
@@ -53,11 +61,9 @@ class Host:
     def ec2_instances_api(self):
         if not self.is_aws_ec2:
             raise ValueError("Not an AWS EC2 host")
-        from aqx.awslib import EC2Instances, Options
+        from aqx.awslib import get_ec2_instances, Options
 
-        api = EC2Instances(options=typing.cast(Options, self.aws_options))
-        self.__dict__["ec2_instances_api"] = api
-        return api
+        return get_ec2_instances(typing.cast(Options, self.aws_options))
 
     def get_inet_address(self):
         if self.is_aws_ec2:
@@ -67,7 +73,18 @@ class Host:
         else:
             return self.address
 
-    def make_ssh_connection(self):
+    def make_ssh_connection(self, pool=None):
+        """
+        :param pool: sshlib.SSHPool to take a connected client from;
+            it goes back to the pool when its context manager exits
+        """
+        if pool is not None:
+            key = (self.name, self.address, self.username, self.private_key_path)
+            ssh = pool.checkout(key, self.make_ssh_connection)
+            # the same server may be configured with another home_dir
+            # by whoever has put the connection into the pool
+            ssh.home_dir = self.home_dir
+            return ssh
         if self.is_aws_ec2:
             api = self.ec2_instances_api
             instance = api.get_by(name=self.address)
@@ -81,12 +98,52 @@ class Host:
                 self.address, self.username, self.private_key_path, self.home_dir
             )
 
-    def get_shh_connect_commandline(self):
+    def get_shh_connect_commandline(
+        self, control_path=None, control_persist=None, master_running=False
+    ):
+        """
+        :param control_path: socket of an OpenSSH master connection shared
+            by the sessions; the first session starts it
+        :param control_persist: seconds the master outlives its last session
+        :param master_running: the master is up, so the address isn't looked up
+        """
+        flags = ""
         if self.is_aws_ec2:
-            flags = "-o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
-        else:
-            flags = ""
-        return (
-            f"ssh {flags} -A -i {self.private_key_path} "
-            f"{self.username}@{self.get_inet_address()}"
-        )
+            flags += " -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no"
+        if control_path is not None:
+            flags += (
+                f" -o ControlMaster=auto -o ControlPath={shlex.quote(control_path)}"
+            )
+            if control_persist is not None:
+                flags += f" -o ControlPersist={control_persist}"
+        # sessions of a running master don't connect anywhere themselves
+        address = self.name if master_running else self.get_inet_address()
+        return f"ssh{flags} -A -i {self.private_key_path} {self.username}@{address}"
+
+
+def prefetch_addresses(hosts: typing.Iterable[Host]):
+    """
+    Resolves EC2 instances of many hosts at once: one lookup per region
+    and credentials, all regions in parallel. Hosts then take their addresses
+    from the shared inventory without calling AWS one by one.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    groups = {}
+    for host in hosts:
+        if host.is_aws_ec2:
+            api = host.ec2_instances_api
+            groups.setdefault(id(api), (api, set()))[1].add(host.address)
+    if not groups:
+        return
+    with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+        futures = [
+            executor.submit(api.get_many, names=sorted(names))
+            for api, names in groups.values()
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except KeyError:
+                # the rest are resolved; unknown ones fail on their own lookup
+                pass
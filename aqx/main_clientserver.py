@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+import os
+import sys
+import socket
+import subprocess
+import threading
+import time
+from aqx.protocol import (
+    Protocol,
+    Window,
+    encode_frame,
+    encode_request,
+    pack_window,
+    unpack_window,
+    read_frame,
+    make_runtime_dir,
+    DAEMON_SOCKET_PATH,
+    TOKEN_PATH,
+    DAEMON_LOG_PATH,
+    MAX_FRAME_SIZE,
+)
+
+DAEMON_START_TIMEOUT = 10
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"usage: {os.path.basename(sys.argv[0])} COMMAND [ARGS...]")
+        sys.exit(2)
+    sys.exit(run(sys.argv[1], sys.argv[2:]))
+
+
+def run(cmd_type, cmd_line):
+    sock = _connect()
+    with sock:
+        try:
+            with open(TOKEN_PATH) as token_f:
+                token = token_f.read()
+        except OSError as exc:
+            print(f"aqx: can't read the daemon token: {exc}", file=sys.stderr)
+            return 1
+        conn = _DaemonConnection(sock)
+        conn.send(encode_request(token, cmd_type, os.getcwd(), cmd_line))
+        try:
+            return conn.relay()
+        except KeyboardInterrupt:
+            conn.cancel()
+            print("aqx: cancelled", file=sys.stderr)
+            return 130
+        except BrokenPipeError:
+            # whoever reads our output has gone (e.g. "| head"), stop the command
+            conn.cancel()
+            devnull_fd = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull_fd, sys.stdout.fileno())
+            return 141
+
+
+class _DaemonConnection:
+    def __init__(self, sock: socket.socket):
+        self._sock = sock
+        self._rfile = sock.makefile("rb")
+        self._send_lock = threading.Lock()
+        self._stdin_window = Window()
+        self._stdin_thread = None
+
+    def send(self, data):
+        with self._send_lock:
+            self._sock.sendall(data)
+
+    def _send_quietly(self, data):
+        try:
+            self.send(data)
+        except OSError:
+            # the daemon may have finished the command and closed the connection,
+            # the remaining frames are still to be read
+            pass
+
+    def cancel(self):
+        self._send_quietly(encode_frame(Protocol.CANCEL))
+
+    def relay(self):
+        """
+        Dispatches the daemon's frames until the command exits.
+        :return: exit code
+        """
+        while True:
+            frame = read_frame(self._rfile)
+            if frame is None:
+                print("aqx: connection to the daemon is lost", file=sys.stderr)
+                return 1
+            frame_type, payload = frame
+            if frame_type in (Protocol.STDOUT, Protocol.STDERR):
+                out = sys.stdout if frame_type == Protocol.STDOUT else sys.stderr
+                out.buffer.write(payload)
+                out.buffer.flush()
+                # acknowledge only what has been written out, so the daemon
+                # can't get ahead of a slow consumer of our output
+                self._send_quietly(
+                    encode_frame(Protocol.WINDOW, pack_window(len(payload)))
+                )
+            elif frame_type == Protocol.WINDOW:
+                self._stdin_window.grant(unpack_window(payload))
+                if self._stdin_thread is None:
+                    self._stdin_thread = threading.Thread(
+                        target=self._send_stdin, daemon=True
+                    )
+                    self._stdin_thread.start()
+            elif frame_type == Protocol.EXEC:
+                os.system(payload.decode("utf-8"))
+            elif frame_type == Protocol.BROWSE_URL:
+                import webbrowser
+
+                webbrowser.open(payload.decode("utf-8"))
+            elif frame_type == Protocol.EXIT:
+                return int(payload)
+
+    def _send_stdin(self):
+        stdin_fd = sys.stdin.fileno()
+        while True:
+            n_bytes = self._stdin_window.consume(MAX_FRAME_SIZE)
+            data = os.read(stdin_fd, n_bytes)
+            self._stdin_window.grant(n_bytes - len(data))
+            self._send_quietly(encode_frame(Protocol.STDIN, data))
+            if not data:
+                return
+
+
+def _connect():
+    try:
+        return _connect_socket()
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    _spawn_daemon()
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while True:
+        try:
+            return _connect_socket()
+        except (FileNotFoundError, ConnectionRefusedError):
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def _connect_socket():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET_PATH)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _spawn_daemon():
+    make_runtime_dir()
+    with open(DAEMON_LOG_PATH, "ab") as log_f:
+        subprocess.Popen(
+            [sys.executable, "-m", "aqx.server_main"],
+            stdin=subprocess.DEVNULL,
+            stdout=log_f,
+            stderr=subprocess.STDOUT,
+            start_new_session=True,
+        )
@@ -15,6 +15,10 @@ def main_deploy():
     _run_main(tool_cli.interface_deploy)
 
 
+def main_exec():
+    _run_main(tool_cli.interface_exec)
+
+
 def main_openserver():
     _run_main(tool_cli.interface_openserver)
 
@@ -54,7 +58,7 @@ def _run_main(cli_fn):
     try:
         sys.exit(func(opts, exec_srv))
     finally:
-        pass
+        exec_srv.shutdown()
 
 
 class _LevelConditionalFormatter(logging.Formatter):
@@ -0,0 +1,245 @@
+import os
+import gzip
+import contextlib
+import collections
+import json
+import shlex
+import difflib
+import hashlib
+import logging
+import threading
+from aqx import sshlib
+from aqx.protocol import RUNTIME_DIR
+
+
+log = logging.getLogger(__name__)
+
+LOCAL_PATCH_DIR = os.path.join(RUNTIME_DIR, "patches")
+# relative to the remote user's home, where exec channels and SFTP start
+REMOTE_PATCH_DIR = ".cache/aqx/patches"
+# patches kept on each side, least recently used ones are removed
+LOCAL_KEEP = 50
+REMOTE_KEEP = 20
+# recent remote patches offered as delta bases
+DELTA_CANDIDATES = 8
+# a delta is worth it only if it's noticeably smaller than the patch itself
+DELTA_MAX_RATIO = 0.8
+# diffing is quadratic at worst, and every server needing the delta waits for it,
+# so bigger patches are sent whole
+DELTA_MAX_LINES = 5000
+
+# prints the cache dir $1, then "hit" if the patch $2 is cached,
+# otherwise the cached patches, most recently used first
+CHECK_SCRIPT = """\
+mkdir -p "$1" && cd "$1" && pwd
+if [ -f "$2" ]; then
+    touch "$2"
+    echo hit
+else
+    ls -t | grep -v '\\.tmp$' | head -n "$3"
+fi
+"""
+
+# stores stdin decoded by $3 as the patch $2, verifying its checksum,
+# and drops the least recently used patches beyond $4
+STORE_SCRIPT = """\
+set -e
+cd "$1"
+tmp="$2.$$.tmp"
+trap 'rm -f "$tmp"' EXIT
+sh -c "$3" > "$tmp"
+if [ "$(sha256sum < "$tmp" | cut -d ' ' -f 1)" != "$2" ]; then
+    echo "checksum mismatch of $2" >&2
+    exit 1
+fi
+mv "$tmp" "$2"
+ls -t | grep -v '\\.tmp$' | tail -n +$(($4 + 1)) | xargs -r rm -f --
+"""
+
+# rebuilds a patch from the cached base $1 and a gzipped delta on stdin
+APPLY_DELTA_SCRIPT = """\
+import gzip, sys
+base = open(sys.argv[1], "rb").read().splitlines(keepends=True)
+out = sys.stdout.buffer
+for op in __import__("json").loads(gzip.decompress(sys.stdin.buffer.read())):
+    if op[0] == "c":
+        out.writelines(base[op[1]:op[2]])
+    else:
+        out.write(op[1].encode("latin-1"))
+"""
+
+
+class PatchCache:
+    """
+    Patches stored on remote hosts under their sha256, so that a redeploy
+    of the same patch uploads nothing and a changed one is sent as a delta
+    against a patch the host already has. Sent patches are kept locally too,
+    to compute the deltas from.
+    """
+
+    def __init__(self, local_dir=LOCAL_PATCH_DIR):
+        self.local_dir = local_dir
+        # (base sha, patch sha) -> gzipped delta or None if it isn't worth it;
+        # servers of a deploy mostly share the base, the diff is computed once
+        self._deltas = {}
+        self._delta_locks = collections.defaultdict(threading.Lock)
+        self._deltas_lock = threading.Lock()
+
+    def ensure_remote(self, ssh: sshlib.SSH, patch: bytes, compress=None) -> str:
+        """
+        :return: absolute path of the patch on the remote host
+        """
+        sha = hashlib.sha256(patch).hexdigest()
+        self._store_local(sha, patch)
+        output = ssh.cmd(
+            _sh_command(CHECK_SCRIPT, REMOTE_PATCH_DIR, sha, DELTA_CANDIDATES)
+        )
+        remote_dir, *listing = output.decode().splitlines()
+        remote_path = f"{remote_dir}/{sha}"
+        if listing == ["hit"]:
+            log.info("%s: patch %s is cached", ssh, sha[:12])
+            return remote_path
+
+        delta = self._make_delta(patch, sha, listing)
+        if delta is not None:
+            base_sha, delta_data = delta
+            log.info(
+                "%s: sending patch %s as %d bytes delta against %s",
+                ssh,
+                sha[:12],
+                len(delta_data),
+                base_sha[:12],
+            )
+            decoder = "python3 -c " + shlex.quote(APPLY_DELTA_SCRIPT) + " " + base_sha
+            try:
+                self._store_remote(ssh, remote_dir, sha, decoder, delta_data)
+                return remote_path
+            except sshlib.SshCommandError:
+                log.warning(
+                    "%s: could not apply patch delta, sending it whole",
+                    ssh,
+                    exc_info=True,
+                )
+
+        log.info("%s: sending patch %s...", ssh, sha[:12])
+        level = sshlib.resolve_compression_level(ssh, compress, upload=True)
+        if level is None:
+            self._store_remote(ssh, remote_dir, sha, "cat", patch)
+        else:
+            self._store_remote(
+                ssh, remote_dir, sha, "gzip -d -c", gzip.compress(patch, level)
+            )
+        return remote_path
+
+    def seed_remotes(
+        self, connections, patch: bytes, fanout=2, session_slot=contextlib.nullcontext
+    ):
+        """
+        Puts the patch into the caches of many hosts at once, relaying it
+        from host to host, see relay.relay_file for the parameters.
+        :return: list of exceptions, None for the hosts that have got the patch
+        """
+        from aqx import relay
+
+        sha = hashlib.sha256(patch).hexdigest()
+        self._store_local(sha, patch)
+        tmp_path = shlex.quote(f"{REMOTE_PATCH_DIR}/{sha}") + ".$$.tmp"
+        install_command = (
+            f"mkdir -p {shlex.quote(REMOTE_PATCH_DIR)}"
+            f' && cp "$1" {tmp_path}'
+            f" && mv {tmp_path} {shlex.quote(f'{REMOTE_PATCH_DIR}/{sha}')}"
+        )
+        return relay.relay_file(
+            connections,
+            os.path.join(self.local_dir, sha),
+            [install_command] * len(connections),
+            fanout,
+            session_slot=session_slot,
+        )
+
+    def _store_remote(self, ssh, remote_dir, sha, decoder, data):
+        ssh.cmd_input(
+            _sh_command(STORE_SCRIPT, remote_dir, sha, decoder, REMOTE_KEEP), data
+        )
+
+    def _make_delta(self, patch, sha, remote_shas):
+        """
+        :return: (base sha, gzipped delta) against the most recent remote patch
+            that is also known locally, or None if there's no good base
+        """
+        for base_sha in remote_shas:
+            base = self._load_local(base_sha)
+            if base is None:
+                continue
+            key = (base_sha, sha)
+            with self._deltas_lock:
+                delta_lock = self._delta_locks[key]
+            # servers asking for the same delta at once wait for the first one
+            with delta_lock:
+                if key not in self._deltas:
+                    delta = _diff(base, patch)
+                    if delta is not None and len(delta) > len(patch) * DELTA_MAX_RATIO:
+                        delta = None
+                    self._deltas[key] = delta
+            delta = self._deltas[key]
+            return None if delta is None else (base_sha, delta)
+        return None
+
+    def _store_local(self, sha, patch):
+        path = os.path.join(self.local_dir, sha)
+        if os.path.exists(path):
+            os.utime(path)
+            return
+        os.makedirs(self.local_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(patch)
+        os.replace(tmp_path, path)
+        self._cleanup_local()
+
+    def _load_local(self, sha):
+        try:
+            with open(os.path.join(self.local_dir, sha), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _cleanup_local(self):
+        entries = []
+        for entry in os.scandir(self.local_dir):
+            if not entry.name.endswith(".tmp"):
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    pass
+        entries.sort(reverse=True)
+        for _, path in entries[LOCAL_KEEP:]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def _diff(base, patch):
+    """
+    :return: gzipped delta that APPLY_DELTA_SCRIPT turns base into patch with,
+        or None if either of them is too big to diff
+    """
+    base_lines = base.splitlines(keepends=True)
+    patch_lines = patch.splitlines(keepends=True)
+    if max(len(base_lines), len(patch_lines)) > DELTA_MAX_LINES:
+        return None
+    matcher = difflib.SequenceMatcher(None, base_lines, patch_lines, False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append(["c", i1, i2])
+        elif j1 < j2:
+            ops.append(["i", b"".join(patch_lines[j1:j2]).decode("latin-1")])
+    return gzip.compress(json.dumps(ops).encode())
+
+
+def _sh_command(script, *args):
+    return " ".join(
+        shlex.quote(str(arg)) for arg in ["sh", "-c", script, "aqx-patchcache", *args]
+    )
@@ -0,0 +1,137 @@
+# wire format between the aqx daemon and its thin client;
+# keep it free of heavy imports, the client loads it on every command
+import os
+import struct
+import threading
+
+
+RUNTIME_DIR = os.path.expanduser("~/.cache/aqx")
+# every user has a daemon of their own, reachable only through their
+# RUNTIME_DIR, which is kept private (0700)
+DAEMON_SOCKET_PATH = os.path.join(RUNTIME_DIR, "daemon.sock")
+DAEMON_LOCK_PATH = os.path.join(RUNTIME_DIR, "daemon.lock")
+TOKEN_PATH = os.path.join(RUNTIME_DIR, "daemon.token")
+DAEMON_LOG_PATH = os.path.join(RUNTIME_DIR, "daemon.log")
+
+
+def make_runtime_dir():
+    os.makedirs(RUNTIME_DIR, mode=0o700, exist_ok=True)
+    # it may have been created by other aqx code with the default mode
+    os.chmod(RUNTIME_DIR, 0o700)
+
+# every frame is (frame type, payload length) header followed by the payload
+FRAME_HEADER = struct.Struct("!II")
+WINDOW_CREDIT = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024
+# bytes of STDOUT/STDERR the daemon may send before the client acknowledges them
+INITIAL_OUTPUT_WINDOW = 1024 * 1024
+# bytes of STDIN the daemon asks for at once when a command reads its input
+STDIN_WINDOW = 256 * 1024
+
+
+class Protocol:
+    # daemon -> client
+    STDERR = 1
+    STDOUT = 2
+    EXEC = 3
+    BROWSE_URL = 4
+    EXIT = 5
+    # client -> daemon
+    REQUEST = 6
+    STDIN = 7  # empty payload means EOF
+    CANCEL = 9
+    # both ways: the sender is ready to receive that many more bytes
+    # of STDOUT/STDERR (client) or STDIN (daemon)
+    WINDOW = 8
+
+
+def encode_frame(frame_type, payload=b""):
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8")
+    return FRAME_HEADER.pack(frame_type, len(payload)) + payload
+
+
+def pack_window(n_bytes):
+    return WINDOW_CREDIT.pack(n_bytes)
+
+
+def unpack_window(payload):
+    [n_bytes] = WINDOW_CREDIT.unpack(payload)
+    return n_bytes
+
+
+def read_frame(rfile):
+    """
+    :return: (frame type, payload bytes) or None when the stream has ended
+    """
+    header = _read_exactly(rfile, FRAME_HEADER.size)
+    if header is None:
+        return None
+    frame_type, length = FRAME_HEADER.unpack(header)
+    payload = _read_exactly(rfile, length)
+    if payload is None:
+        return None
+    return frame_type, payload
+
+
+def _read_exactly(rfile, n_bytes):
+    data = b""
+    while len(data) < n_bytes:
+        chunk = rfile.read(n_bytes - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def encode_request(token, cmd_type, cwd, cmd_line):
+    payload = b"\0".join(
+        part.encode("utf-8") for part in [token, cmd_type, cwd, *cmd_line]
+    )
+    return encode_frame(Protocol.REQUEST, payload)
+
+
+def decode_request(payload):
+    """
+    :return: token, cmd_type, cwd, cmd_line
+    """
+    token, cmd_type, cwd, *cmd_line = [
+        part.decode("utf-8") for part in payload.split(b"\0")
+    ]
+    return token, cmd_type, cwd, cmd_line
+
+
+class Window:
+    """
+    Flow control credit: how many bytes the peer is ready to accept.
+    """
+
+    def __init__(self, size=0):
+        self._size = size
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def grant(self, n_bytes):
+        with self._cond:
+            self._size += n_bytes
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def consume(self, n_bytes):
+        """
+        Blocks until some credit is available.
+        :return: number of bytes that can be sent now, up to n_bytes;
+            0 if the window is closed
+        """
+        with self._cond:
+            while self._size <= 0 and not self._closed:
+                self._cond.wait()
+            if self._closed:
+                return 0
+            n_bytes = min(n_bytes, self._size)
+            self._size -= n_bytes
+            return n_bytes
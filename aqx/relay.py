@@ -0,0 +1,172 @@
+import shlex
+import hashlib
+import contextlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from aqx import sshlib
+
+
+log = logging.getLogger(__name__)
+
+# relative to the remote user's home
+REMOTE_STAGING_DIR = ".cache/aqx/relay"
+MAX_WORKERS = 32
+# options of host-to-host ssh hops: keys come from the forwarded agent,
+# and there's nobody to answer prompts on the way
+HOP_SSH_OPTIONS = [
+    "-A",
+    "-o",
+    "BatchMode=yes",
+    "-o",
+    "StrictHostKeyChecking=accept-new",
+    "-o",
+    "ConnectTimeout=30",
+]
+
+# reads the payload from stdin into the staging file $2 in dir $1
+# and keeps it only if its sha256 is $3
+RECEIVE_SCRIPT = """\
+set -e
+mkdir -p "$1"
+cd "$1"
+tmp="$2.$$.tmp"
+trap 'rm -f "$tmp"' EXIT
+cat > "$tmp"
+if [ "$(sha256sum < "$tmp" | cut -d ' ' -f 1)" != "$3" ]; then
+    echo "checksum mismatch of the relayed $2" >&2
+    exit 1
+fi
+mv "$tmp" "$2"
+"""
+
+
+def relay_file(
+    connections,
+    local_path,
+    install_commands,
+    fanout=2,
+    callback=None,
+    session_slot=contextlib.nullcontext,
+):
+    """
+    Delivers a local file to many hosts sending it from here only `fanout`
+    times: each host that has got it forwards it to `fanout` more hosts
+    over ssh with agent forwarding, so the hosts must be able to reach
+    each other with the keys of the local agent. Every hop verifies the sha256,
+    a failed hop is retried directly from here.
+
+    :param connections: connected sshlib.SSH of the target hosts, in the order
+        they're placed into the tree breadth first; fanout=1 makes a chain
+    :param install_commands: shell command for each host that puts the delivered
+        file where it belongs; it's given the staging file path as $1
+    :param callback: called with (ssh, error or None) for each host as it's done
+    :param session_slot: returns a context manager held while delivering
+        to a host, see core.AppService.session_slot
+    :return: list of exceptions, None for the hosts that have got the file
+    """
+    sha = _file_sha256(local_path)
+    staging_path = f"{REMOTE_STAGING_DIR}/{sha}"
+    errors = [None] * len(connections)
+    n_done = threading.Semaphore(0)
+
+    def send(ssh, index, source_index):
+        if source_index is None:
+            _upload(ssh, local_path, sha)
+        else:
+            try:
+                _forward(connections[source_index], ssh, sha)
+            except Exception:
+                log.warning(
+                    "%s: relay from %s failed, sending directly",
+                    ssh,
+                    connections[source_index],
+                    exc_info=True,
+                )
+                _upload(ssh, local_path, sha)
+        ssh.cmd(_sh_command(install_commands[index], staging_path))
+
+    def deliver(index, source_index):
+        ssh = connections[index]
+        try:
+            with session_slot():
+                send(ssh, index, source_index)
+        except Exception as exc:
+            log.error("%s: relay failed: %s", ssh, exc)
+            errors[index] = exc
+        finally:
+            # nobody can forward it from a failed host, so its subtree goes from here
+            source = index if errors[index] is None else None
+            first_child = (index + 1) * fanout
+            for child in range(
+                first_child, min(first_child + fanout, len(connections))
+            ):
+                executor.submit(deliver, child, source)
+            n_done.release()
+        if callback is not None:
+            try:
+                callback(ssh, errors[index])
+            except Exception:
+                log.warning("%s: relay callback failed", ssh, exc_info=True)
+
+    n_workers = max(min(len(connections), MAX_WORKERS), 1)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        for index in range(min(fanout, len(connections))):
+            executor.submit(deliver, index, None)
+        for _ in connections:
+            n_done.acquire()
+        # forwarding is over, staging files aren't needed anymore
+        for ssh in connections:
+            executor.submit(_cleanup, ssh, staging_path)
+    return errors
+
+
+def _upload(ssh: sshlib.SSH, local_path, sha):
+    log.info("%s: sending %s for relay...", ssh, local_path)
+    wait_fn, stdin, stdout, stderr = ssh.cmd_stream_stdin(
+        _sh_command(RECEIVE_SCRIPT, REMOTE_STAGING_DIR, sha, sha)
+    )
+    try:
+        with stdin, open(local_path, "rb") as f:
+            for block in iter(lambda: f.read(sshlib.SHARD_BLOCK_SIZE), b""):
+                stdin.write(block)
+    except sshlib.RemoteStdinClosed:
+        # the receiver has exited prematurely, its error is reported below
+        log.debug("%s: relay upload interrupted", ssh, exc_info=True)
+    stdout.read()
+    errors = stderr.read().decode()
+    rc = wait_fn()
+    if rc != 0:
+        raise sshlib.SshCommandError(f"relay upload -> exited with {rc}: {errors}")
+
+
+def _forward(source: sshlib.SSH, target: sshlib.SSH, sha):
+    log.info("%s: forwarding relayed file to %s", source, target)
+    receive_command = _sh_command(RECEIVE_SCRIPT, REMOTE_STAGING_DIR, sha, sha)
+    hop_command = " ".join(
+        shlex.quote(arg)
+        for arg in ["ssh", *HOP_SSH_OPTIONS, *target.ssh_command_args()]
+        + [receive_command]
+    )
+    source.cmd(f"{hop_command} < {shlex.quote(REMOTE_STAGING_DIR + '/' + sha)}")
+
+
+def _cleanup(ssh: sshlib.SSH, staging_path):
+    try:
+        ssh.cmd(f"rm -f {shlex.quote(staging_path)}")
+    except Exception:
+        log.warning("%s: could not remove %s", ssh, staging_path, exc_info=True)
+
+
+def _file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(sshlib.SHARD_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _sh_command(script, *args):
+    return " ".join(
+        shlex.quote(str(arg)) for arg in ["sh", "-c", script, "aqx-relay", *args]
+    )
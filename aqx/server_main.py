@@ -1,54 +1,316 @@
 import socketserver
 import argparse
+import logging
 import logging.config
 import threading
-import struct
+import secrets
+import hmac
+import io
+import os
+import sys
+import fcntl
 from aqx import tool_cli, core
+from aqx.protocol import (
+    Protocol,
+    Window,
+    encode_frame,
+    pack_window,
+    unpack_window,
+    read_frame,
+    decode_request,
+    make_runtime_dir,
+    DAEMON_SOCKET_PATH,
+    DAEMON_LOCK_PATH,
+    TOKEN_PATH,
+    MAX_FRAME_SIZE,
+    INITIAL_OUTPUT_WINDOW,
+    STDIN_WINDOW,
+)
+
+
+log = logging.getLogger(__name__)
 
 
 interfaces_map = {
     "ssh": tool_cli.interface_ssh,
     "filetransfer": tool_cli.interface_filetransfer,
     "deploy": tool_cli.interface_deploy,
+    "exec": tool_cli.interface_exec,
     "openserver": tool_cli.interface_openserver,
+    "status": tool_cli.interface_status,
 }
+# commands that only read the daemon's own state and never wait in the queue
+unscheduled_commands = {"status"}
 
 
-class Protocol:
-    STDERR = 1
-    STDOUT = 2
-    EXEC = 3
-    BROWSE_URL = 4
+class AqxRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        frame = read_frame(self.rfile)
+        if frame is None or frame[0] != Protocol.REQUEST:
+            log.warning("rejected malformed request")
+            return
+        token, cmd_type, cwd, cmd_line = decode_request(frame[1])
+        if not hmac.compare_digest(token, self.server.token):
+            log.warning("rejected request with invalid token")
+            self.wfile.write(
+                encode_frame(Protocol.STDERR, "aqx: the daemon rejected the token\n")
+                + encode_frame(Protocol.EXIT, "1")
+            )
+            return
 
+        client = RemoteClient(self.wfile, cwd)
+        reader_thread = threading.Thread(
+            target=client.receive_frames, args=(self.rfile,), daemon=True
+        )
+        reader_thread.start()
+        core.set_current_client(client)
+        try:
+            exit_code = self.run_command(cmd_type, cmd_line)
+        finally:
+            core.set_current_client(None)
+        if not client.cancelled.is_set():
+            client.send(Protocol.EXIT, str(exit_code))
 
-def encode_message(protocol_header, msg):
-    result = struct.pack("!I", protocol_header)
-    result += msg.encode("utf-8")
-    result += b"\0"
-    return result
+    def run_command(self, cmd_type, cmd_line):
+        if cmd_type not in interfaces_map:
+            print(f"unknown command: {cmd_type}", file=sys.stderr)
+            return 2
+        cli, call_cmd = interfaces_map[cmd_type]()
+        cli.prog = f"aqx {cmd_type}"
+        execution_service = self.server.execution_service
+        try:
+            opts = cli.parse_args(cmd_line)
+            if cmd_type in unscheduled_commands:
+                result = call_cmd(opts, execution_service)
+            else:
+                with execution_service.scheduler.slot(
+                    _request_hosts(opts), core.current_client().cancelled
+                ):
+                    result = call_cmd(opts, execution_service)
+        except SystemExit as exc:
+            result = exc.code
+        except core.SchedulerBusy as exc:
+            print(f"aqx daemon is busy: {exc}", file=sys.stderr)
+            return 75  # EX_TEMPFAIL
+        except core.RequestCancelled:
+            log.info("%s cancelled by the client", cmd_type)
+            return 130
+        except Exception:
+            log.exception("%s failed", cmd_type)
+            return 1
+        if result is None:
+            return 0
+        if isinstance(result, int):
+            return result
+        print(result, file=sys.stderr)
+        return 1
 
 
-class AqxRequestHandler(socketserver.StreamRequestHandler):
-    def handle(self):
-        data = self.rfile.read()
-        self.server.client_logger.stream = self.wfile
-        parts = data.split(b"\0")
-        parts = [part.decode("utf-8") for part in parts]
+def _request_hosts(opts):
+    """
+    :return: names of the hosts the parsed command is going to connect to
+    """
+    names = getattr(opts, "servers", None) or [getattr(opts, "server", None)]
+    names = [*names, *getattr(opts, "relay_to", [])]
+    app = core.AppService(opts.config)
+    return {app.maybe_resolve_host_alias(name) or "default" for name in names}
 
-        cmd_type = parts[0]
-        cmd_line = parts[1:]
 
-        cli, call_cmd = interfaces_map[cmd_type]()
-        opts = cli.parse_args(cmd_line)
+class RemoteClient(core.LocalClient):
+    def __init__(self, wfile, cwd):
+        super(RemoteClient, self).__init__(cwd)
+        self._wfile = wfile
+        self._lock = threading.Lock()
+        self._output_window = Window(INITIAL_OUTPUT_WINDOW)
+        self._stdin = _ClientStdin(self)
+        self._stdout = _ClientStream(self, Protocol.STDOUT)
+        self._stderr = _ClientStream(self, Protocol.STDERR)
+
+    @property
+    def stdin(self):
+        return self._stdin
+
+    @property
+    def stdout(self):
+        return self._stdout
+
+    @property
+    def stderr(self):
+        return self._stderr
+
+    def send(self, protocol_header, msg):
+        try:
+            with self._lock:
+                self._wfile.write(encode_frame(protocol_header, msg))
+                self._wfile.flush()
+        except OSError as exc:
+            self._cancel()
+            raise core.RequestCancelled from exc
+
+    def send_output(self, protocol_header, data: bytes):
+        """
+        Sends STDOUT/STDERR data, blocking while the client hasn't consumed
+        what was sent before.
+        """
+        data = memoryview(data)
+        while data:
+            n_bytes = self._output_window.consume(min(len(data), MAX_FRAME_SIZE))
+            if n_bytes == 0:
+                raise core.RequestCancelled
+            self.send(protocol_header, bytes(data[:n_bytes]))
+            data = data[n_bytes:]
+
+    def execute(self, command):
+        self.send(Protocol.EXEC, command)
+
+    def browse_url(self, url):
+        self.send(Protocol.BROWSE_URL, url)
+
+    def receive_frames(self, rfile):
+        while True:
+            try:
+                frame = read_frame(rfile)
+            except (OSError, ValueError):
+                # the request has finished and its socket is closed
+                frame = None
+            if frame is None:
+                # the client has gone away, treat it as cancellation
+                self._cancel()
+                return
+            frame_type, payload = frame
+            if frame_type == Protocol.STDIN:
+                self._stdin.feed(payload)
+            elif frame_type == Protocol.WINDOW:
+                self._output_window.grant(unpack_window(payload))
+            elif frame_type == Protocol.CANCEL:
+                self._cancel()
+            else:
+                log.warning("unexpected frame from the client: %d", frame_type)
+
+    def _cancel(self):
+        self.cancelled.set()
+        self._output_window.close()
+        self._stdin.feed(b"")
+
+
+class _ClientStdin(io.RawIOBase):
+    """
+    Client's stdin, requested from the client by granting it a window
+    only when the command reads it.
+    """
+
+    def __init__(self, client: RemoteClient):
+        super(_ClientStdin, self).__init__()
+        self._client = client
+        self._buffer = bytearray()
+        self._eof = False
+        self._n_requested = 0
+        self._cond = threading.Condition()
+
+    def readable(self):
+        return True
 
-        call_cmd(opts, self.server.execution_service)
+    def readinto(self, b):
+        with self._cond:
+            if not self._buffer and not self._eof and self._n_requested == 0:
+                self._n_requested = STDIN_WINDOW
+                self._client.send(Protocol.WINDOW, pack_window(STDIN_WINDOW))
+            while not self._buffer and not self._eof:
+                self._cond.wait()
+            if self._client.cancelled.is_set():
+                raise core.RequestCancelled
+            n_bytes = min(len(b), len(self._buffer))
+            b[:n_bytes] = self._buffer[:n_bytes]
+            del self._buffer[:n_bytes]
+        return n_bytes
 
-    def finish(self):
-        self.server.client_logger.stream = None
+    def feed(self, data):
+        with self._cond:
+            if data:
+                self._buffer += data
+                self._n_requested -= len(data)
+            else:
+                self._eof = True
+            self._cond.notify_all()
+
+
+class _ClientStream(io.TextIOBase):
+    def __init__(self, client: RemoteClient, protocol_header):
+        self._client = client
+        self._protocol_header = protocol_header
+        self.buffer = _ClientBinaryStream(client, protocol_header)
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self.buffer.write(text.encode("utf-8"))
+        return len(text)
+
+
+class _ClientBinaryStream(io.RawIOBase):
+    def __init__(self, client: RemoteClient, protocol_header):
+        super(_ClientBinaryStream, self).__init__()
+        self._client = client
+        self._protocol_header = protocol_header
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._client.send_output(self._protocol_header, data)
+        return len(data)
+
+
+class _ThreadRoutedStream(io.TextIOBase):
+    """
+    Replaces sys.stdout/sys.stderr, so whatever a request thread prints
+    (e.g. argparse messages) reaches its client rather than the daemon log.
+    """
+
+    def __init__(self, fallback, client_stream_name):
+        self._fallback = fallback
+        self._client_stream_name = client_stream_name
+
+    def _target(self):
+        client = core.current_client()
+        if isinstance(client, RemoteClient):
+            return getattr(client, self._client_stream_name)
+        return self._fallback
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
 
 
 def main():
-    client_logger = LogToClientHandler()
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--max-running", type=int, default=8, help="commands run at once")
+    cli.add_argument(
+        "--max-per-host",
+        type=int,
+        default=2,
+        help="commands run at once against the same host",
+    )
+    cli.add_argument(
+        "--max-queued",
+        type=int,
+        default=64,
+        help="commands waiting for their turn; more are rejected",
+    )
+    cli.add_argument(
+        "--max-sessions",
+        type=int,
+        default=32,
+        help="hosts worked on at once by all commands fanning out to many hosts",
+    )
+    opts = cli.parse_args()
+
     logging.config.dictConfig(
         {
             "version": 1,
@@ -67,7 +329,7 @@ def main():
                 "client": {
                     "level": "INFO",
                     "formatter": "standard",
-                    "()": lambda: client_logger,
+                    "()": LogToClientHandler,
                 },
             },
             "loggers": {
@@ -79,34 +341,72 @@ def main():
             },
         }
     )
+    sys.stdout = _ThreadRoutedStream(sys.stdout, "stdout")
+    sys.stderr = _ThreadRoutedStream(sys.stderr, "stderr")
 
-    server = socketserver.ThreadingTCPServer("localhost:11397", AqxRequestHandler)
-    server.execution_service = core.ExecutionService()
-    server.client_logger = client_logger
+    make_runtime_dir()
+    lock_f = open(DAEMON_LOCK_PATH, "w")
+    try:
+        fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # that one's socket and token must remain
+        log.error("another aqx daemon is running")
+        sys.exit(1)
+    # whatever socket is there was left by a daemon that has died
+    try:
+        os.remove(DAEMON_SOCKET_PATH)
+    except FileNotFoundError:
+        pass
 
+    socketserver.ThreadingUnixStreamServer.daemon_threads = True
+    server = socketserver.ThreadingUnixStreamServer(
+        DAEMON_SOCKET_PATH, AqxRequestHandler, bind_and_activate=False
+    )
+    # clients can't connect before listen(), so they never see a stale token
+    server.server_bind()
+    server.token = _write_token()
+    server.server_activate()
+    server.execution_service = core.ExecutionService(
+        max_sessions=opts.max_sessions,
+        scheduler=core.Scheduler(
+            max_running=opts.max_running,
+            max_per_host=opts.max_per_host,
+            max_queued=opts.max_queued,
+        ),
+    )
+    server.execution_service.start()
+    log.info("aqx daemon is listening on %s", DAEMON_SOCKET_PATH)
+    try:
+        server.serve_forever()
+    finally:
+        server.execution_service.shutdown()
+        server.server_close()
+        os.remove(DAEMON_SOCKET_PATH)
+        lock_f.close()
 
-class LogToClientHandler(logging.StreamHandler):
-
-    terminator = b""
-
-    def __init__(self):
-        self._stream = threading.local()
-        super(LogToClientHandler, self).__init__()
-        self.stream = None
 
-    @property
-    def stream(self):
-        return self._stream.stream
+def _write_token():
+    token = secrets.token_hex(16)
+    tmp_path = TOKEN_PATH + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(token)
+    os.replace(tmp_path, TOKEN_PATH)
+    return token
 
-    @stream.setter
-    def stream(self, stream):
-        self._stream.stream = stream
 
+class LogToClientHandler(logging.Handler):
     def emit(self, record):
-        if self.stream is None:
+        client = core.current_client()
+        if not isinstance(client, RemoteClient):
             return
-        return super(LogToClientHandler, self).emit(record)
+        try:
+            client.stderr.write(self.format(record) + "\n")
+        except core.RequestCancelled:
+            pass
+        except Exception:
+            self.handleError(record)
+
 
-    def format(self, record):
-        msg = super(LogToClientHandler, self).format(record)
-        return encode_message(Protocol.STDERR, msg + "\n")
+if __name__ == "__main__":
+    main()
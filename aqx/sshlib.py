@@ -6,10 +6,44 @@ import warnings
 import stat
 import fnmatch
 import threading
+import queue
+import contextlib
+import json
+import shlex
+import tarfile
+import hashlib
+import time
+import zlib
+import functools
+import socket
+import select
+import dataclasses
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 
 log = logging.getLogger("sshlib")
 
+SHARD_RANGE_SIZE = 32 * 1024 * 1024
+SHARD_BLOCK_SIZE = 1024 * 1024
+SHARDED_MIN_FILE_SIZE = 2 * SHARD_RANGE_SIZE
+PARTIAL_SUFFIX = ".aqx-partial"
+THROUGHPUT_PROBE_SIZE = 512 * 1024
+KEEPALIVE_INTERVAL = 30
+# command output read off the channel at once, and kept of each stream by default
+STREAM_CHUNK_SIZE = 32 * 1024
+MAX_RETAINED_OUTPUT = 1024 * 1024
+# longer lines are passed on in pieces
+MAX_LINE_LENGTH = 64 * 1024
+# (link throughput in bytes/s below which the level pays off, gzip level);
+# on faster links compressing costs more time than it saves
+COMPRESSION_LEVELS = [
+    (1024 * 1024, 9),
+    (10 * 1024 * 1024, 6),
+    (40 * 1024 * 1024, 3),
+    (100 * 1024 * 1024, 1),
+]
+
 
 class SSH:
     def __init__(self, ssh_address, ssh_user, private_key_path=None, home_dir=None):
@@ -22,7 +56,7 @@ class SSH:
             hostname, port = ssh_address, paramiko.config.SSH_PORT
         if private_key_path is None:
             private_key_path = os.path.expanduser("~/.ssh/id_rsa")
-        pkey = paramiko.RSAKey.from_private_key_file(private_key_path)
+        pkey = _load_private_key(private_key_path)
         self._address = ssh_address
         self._connect_params = dict(
             hostname=hostname, port=port, username=ssh_user, timeout=30, pkey=pkey
@@ -32,12 +66,21 @@ class SSH:
         self._sftp = None
         self.home_dir = home_dir
         self._connected = threading.Event()
+        # bytes/s by direction, True for uploads
+        self._throughput = {}
+        self._pool = None
+        self._pool_key = None
 
     def __enter__(self):
-        self.start()
+        if not self.connected:
+            self.start()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.stop()
+        if self._pool is not None:
+            self._pool.checkin(self)
+        else:
+            self.stop()
 
     def start(self):
         log.info("%r: connecting...", self)
@@ -45,83 +88,402 @@ class SSH:
             # annoying deprecation warning from Crypto lib
             warnings.simplefilter("ignore")
             self._client.connect(**self._connect_params)
+            # lets the server and NATs in between see traffic on idle connections
+            self._client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
             self._connected.set()
 
     def stop(self):
         self._connected.clear()
         if self._sftp is not None:
             self._sftp.close()
+            self._sftp = None
         self._client.close()
 
     @property
     def connected(self):
         return self._connected.isSet()
 
-    def cmd_stream(self, command: str):
+    def is_alive(self):
+        transport = self._client.get_transport()
+        return self.connected and transport is not None and transport.is_active()
+
+    def ping(self, timeout=10) -> float:
+        """
+        Runs a no-op command, giving up after timeout.
+        :return: round trip time in seconds
+        """
+        if not self.is_alive():
+            raise SshCommandError(f"{self!r}: not connected")
+        start_time = time.monotonic()
+        chan = self._client.get_transport().open_session(timeout=timeout)
+        try:
+            chan.exec_command("true")
+            if not chan.status_event.wait(timeout):
+                raise socket.timeout(f"{self!r}: no reply in {timeout}s")
+        finally:
+            chan.close()
+        return time.monotonic() - start_time
+
+    def _exec_channel(self, command: str):
         log.info("%r: cmd: %s", self, command)
         chan = self._client.get_transport().open_session()  # type: paramiko.Channel
         paramiko.agent.AgentRequestHandler(chan)
         chan.exec_command(command)
-        stdout = chan.makefile("rb")
-        stderr = chan.makefile_stderr("rb")
 
         def wait_fn():
             rc = chan.recv_exit_status()
             chan.close()
             return rc
 
+        return chan, wait_fn
+
+    def cmd_stream(self, command: str):
+        chan, wait_fn = self._exec_channel(command)
+        stdout = chan.makefile("rb")
+        stderr = chan.makefile_stderr("rb")
         return wait_fn, stdout, stderr
 
+    def cmd_stream_stdin(self, command: str):
+        """
+        Like cmd_stream, but also returns a writable stdin of the command.
+        Closing it sends EOF to the remote side.
+        :return: wait_fn, stdin, stdout, stderr
+        """
+        chan, wait_fn = self._exec_channel(command)
+        stdin = _ChannelStdin(chan)
+        stdout = chan.makefile("rb")
+        stderr = chan.makefile_stderr("rb")
+        return wait_fn, stdin, stdout, stderr
+
+    def cmd_iter(
+        self, command: str, lines=False, stdin_data: bytes = None, timeout=None
+    ):
+        """
+        Runs the command reading its stdout and stderr concurrently,
+        so a chatty stream can't stall the other one.
+        :param lines: yield whole lines instead of chunks as they arrive
+        :param stdin_data: fed to the command's stdin, which is closed after it
+        :param timeout: seconds after which the channel is closed
+            and CommandTimeout is raised
+        :return: CommandOutput
+        """
+        chan, wait_fn = self._exec_channel(command)
+        if stdin_data is not None:
+            stdin = _ChannelStdin(chan)
+
+            def send_input():
+                try:
+                    with stdin:
+                        stdin.write(stdin_data)
+                except OSError:
+                    # the command has exited without reading all of its input,
+                    # its exit code tells whether that's an error
+                    log.debug(
+                        "%r: input of %s interrupted", self, command, exc_info=True
+                    )
+
+            threading.Thread(target=send_input, daemon=True).start()
+        return CommandOutput(chan, wait_fn, lines, command, timeout)
+
+    def cmd_run(
+        self,
+        command: str,
+        on_stdout=None,
+        on_stderr=None,
+        lines=False,
+        stdin_data: bytes = None,
+        max_retained=MAX_RETAINED_OUTPUT,
+        check=True,
+        timeout=None,
+    ):
+        """
+        Runs the command passing its output to the callbacks as it arrives.
+        :param on_stdout: called with each chunk (or line) of stdout
+        :param on_stderr: called with each chunk (or line) of stderr
+        :param max_retained: bytes of the tail of each stream kept in the result,
+            None keeps everything
+        :param check: raise SshCommandError if the command exits with non-zero
+        :param timeout: see cmd_iter
+        :return: CommandResult
+        """
+        callbacks = {"stdout": on_stdout, "stderr": on_stderr}
+        retained = {
+            "stdout": _OutputTail(max_retained),
+            "stderr": _OutputTail(max_retained),
+        }
+        output = self.cmd_iter(command, lines, stdin_data, timeout)
+        with contextlib.closing(output):
+            for stream, data in output:
+                retained[stream].append(data)
+                if callbacks[stream] is not None:
+                    callbacks[stream](data)
+        result = CommandResult(
+            exit_code=output.exit_code,
+            stdout=retained["stdout"].getvalue(),
+            stderr=retained["stderr"].getvalue(),
+            truncated=retained["stdout"].truncated or retained["stderr"].truncated,
+        )
+        if check and result.exit_code != 0:
+            errors = result.stderr.decode(errors="replace")
+            raise SshCommandError(
+                f"{command} -> exited with {result.exit_code}: {errors}"
+            )
+        return result
+
     def cmd(self, command: str) -> bytes:
-        wait_fn, stdout, stderr = self.cmd_stream(command)
-        output = stdout.read()
-        errors = stderr.read().decode()
-        rc = wait_fn()
-        if rc != 0:
-            raise SshCommandError(f"{command} -> exited with {rc}: {errors}")
-        return output
+        output = []
+        self.cmd_run(command, on_stdout=output.append)
+        return b"".join(output)
+
+    def cmd_input(self, command: str, data: bytes) -> bytes:
+        output = []
+        self.cmd_run(command, on_stdout=output.append, stdin_data=data)
+        return b"".join(output)
 
     def _get_stfp(self) -> paramiko.SFTP:
         if self._sftp is None:
             self._sftp = self._client.open_sftp()
         return self._sftp
 
-    def send_file(self, remote_path: str, contents, callback=None):
+    def open_sftp(self) -> paramiko.SFTP:
+        """
+        :return: New SFTP session on the same transport, owned by the caller
+        """
+        return self._client.open_sftp()
+
+    def send_file(self, remote_path: str, contents, callback=None, sftp=None):
         log.info("%r: sending file to %s", self, remote_path)
-        if isinstance(contents, (str, bytes)):
-            if isinstance(contents, str):
-                contents = contents.encode()
-            contents_io = io.BytesIO()
-            contents_io.write(contents)
-            contents_io.seek(0)
-            contents = contents_io
-        self._get_stfp().putfo(contents, remote_path, callback=callback)
-
-    def download_file(self, remote_path: str, local_file=None, callback=None) -> bytes:
+        contents = _as_fileobj(contents)
+        sftp = sftp or self._get_stfp()
+        sftp.putfo(contents, remote_path, callback=callback)
+
+    def download_file(
+        self, remote_path: str, local_file=None, callback=None, sftp=None
+    ) -> bytes:
         log.info("%r: downloading file from %s", self, remote_path)
-        if local_file is None:
-            local_file = io.BytesIO()
-            return_value = True
-            need_close = False
-        elif isinstance(local_file, str):
-            local_file = open(local_file, "wb")
-            return_value = False
-            need_close = True
-        else:
-            return_value = False
-            need_close = False
-        self._get_stfp().getfo(remote_path, local_file, callback=callback)
+        local_file, return_value, need_close = _open_local_target(local_file)
+        sftp = sftp or self._get_stfp()
+        sftp.getfo(remote_path, local_file, callback=callback)
         if need_close:
             local_file.close()
         if return_value:
             return local_file.getvalue()
 
+    def send_file_compressed(self, remote_path: str, contents, callback=None, level=6):
+        """
+        Sends gzip stream through a remote "gzip -d" instead of SFTP.
+        """
+        log.info(
+            "%r: sending file to %s with compression level %d", self, remote_path, level
+        )
+        contents = _as_fileobj(contents)
+        n_total = _fileobj_size(contents)
+        command = "gzip -d -c > " + shlex.quote(remote_path)
+        wait_fn, stdin, stdout, stderr = self.cmd_stream_stdin(command)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        n_done = 0
+        try:
+            with stdin:
+                for block in iter(lambda: contents.read(SHARD_BLOCK_SIZE), b""):
+                    stdin.write(compressor.compress(block))
+                    n_done += len(block)
+                    if callback:
+                        callback(n_done, n_total)
+                stdin.write(compressor.flush())
+        except OSError:
+            # remote gzip has exited prematurely, its error is reported below
+            log.debug("%r: compressed stream interrupted", self, exc_info=True)
+        stdout.read()
+        errors = stderr.read().decode()
+        rc = wait_fn()
+        if rc != 0:
+            raise SshCommandError(f"{command} -> exited with {rc}: {errors}")
+
+    def download_file_compressed(
+        self, remote_path: str, local_file=None, callback=None, level=6
+    ) -> bytes:
+        """
+        Downloads the file as gzip stream produced by a remote "gzip" command.
+        """
+        log.info(
+            "%r: downloading file from %s with compression level %d",
+            self,
+            remote_path,
+            level,
+        )
+        n_total = self._get_stfp().stat(remote_path).st_size
+        local_file, return_value, need_close = _open_local_target(local_file)
+        command = "gzip -c -{} < {}".format(level, shlex.quote(remote_path))
+        wait_fn, stdout, stderr = self.cmd_stream(command)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        n_done = 0
+        for block in iter(lambda: stdout.read(SHARD_BLOCK_SIZE), b""):
+            while block:
+                data = decompressor.decompress(block)
+                local_file.write(data)
+                n_done += len(data)
+                # gzip output may consist of several concatenated members
+                block = decompressor.unused_data
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            if callback:
+                callback(n_done, n_total)
+        errors = stderr.read().decode()
+        rc = wait_fn()
+        if need_close:
+            local_file.close()
+        if rc != 0:
+            raise SshCommandError(f"{command} -> exited with {rc}: {errors}")
+        if return_value:
+            return local_file.getvalue()
+
+    def measure_throughput(self, upload=False) -> float:
+        """
+        :param upload: measure the direction to the remote host rather than
+            from it, the two may differ a lot (e.g. an office uplink)
+        :return: bytes per second of the link in that direction, measured
+            once per connection by moving incompressible data
+        """
+        if upload not in self._throughput:
+            start_time = time.monotonic()
+            if upload:
+                self.cmd_input("cat > /dev/null", os.urandom(THROUGHPUT_PROBE_SIZE))
+                n_bytes = THROUGHPUT_PROBE_SIZE
+            else:
+                n_bytes = len(self.cmd(f"head -c {THROUGHPUT_PROBE_SIZE} /dev/urandom"))
+            elapsed = max(time.monotonic() - start_time, 1e-6)
+            self._throughput[upload] = n_bytes / elapsed
+            log.info(
+                "%r: measured %s throughput %.1f KiB/s",
+                self,
+                "upload" if upload else "download",
+                self._throughput[upload] / 1024,
+            )
+        return self._throughput[upload]
+
+    def download_file_sharded(
+        self, remote_path: str, local_path: str, n_shards=4, callback=None
+    ):
+        """
+        Downloads the file by byte ranges over n_shards SFTP sessions.
+        Completed ranges are journaled next to the local file, so an interrupted
+        download continues from where it stopped when called again.
+        """
+        log.info(
+            "%r: downloading file from %s in %d shards", self, remote_path, n_shards
+        )
+        remote_st = self._get_stfp().stat(remote_path)
+        journal_path = local_path + PARTIAL_SUFFIX
+        try:
+            local_size = os.path.getsize(local_path)
+        except FileNotFoundError:
+            local_size = None
+        if local_size != remote_st.st_size:
+            # the file the journal was kept for is gone or has been replaced,
+            # its ranges marked as done would come out zero-filled
+            try:
+                os.remove(journal_path)
+            except FileNotFoundError:
+                pass
+        journal = _RangeJournal.load_or_create(
+            journal_path, remote_st.st_size, remote_st.st_mtime
+        )
+        if journal.done:
+            log.info(
+                "%r: resuming %s - %d of %d ranges already downloaded",
+                self,
+                remote_path,
+                len(journal.done),
+                len(journal.ranges),
+            )
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        fd = os.open(local_path, flags, 0o644)
+        try:
+            os.ftruncate(fd, remote_st.st_size)
+
+            def transfer_range(sftp, offset, length, progress):
+                with sftp.open(remote_path, "rb") as remote_f:
+                    blocks = _split_range(offset, length, SHARD_BLOCK_SIZE)
+                    for (block_offset, _), data in zip(blocks, remote_f.readv(blocks)):
+                        os.pwrite(fd, data, block_offset)
+                        progress(len(data))
+                # the range is journaled as done right after, it must be on disk
+                os.fsync(fd)
+
+            self._run_sharded(journal, n_shards, transfer_range, callback)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        journal.remove()
+
+    def send_file_sharded(
+        self, remote_path: str, local_path: str, n_shards=4, callback=None
+    ):
+        """
+        Uploads the file by byte ranges over n_shards SFTP sessions.
+        """
+        log.info("%r: sending file to %s in %d shards", self, remote_path, n_shards)
+        file_size = os.path.getsize(local_path)
+        sftp = self._get_stfp()
+        with sftp.open(remote_path, "wb"):
+            pass
+        sftp.truncate(remote_path, file_size)
+        journal = _RangeJournal(None, file_size, None)
+
+        def transfer_range(sftp, offset, length, progress):
+            with open(local_path, "rb") as local_f, sftp.open(
+                remote_path, "r+b"
+            ) as remote_f:
+                remote_f.set_pipelined(True)
+                remote_f.seek(offset)
+                for block_offset, block_length in _split_range(
+                    offset, length, SHARD_BLOCK_SIZE
+                ):
+                    data = os.pread(local_f.fileno(), block_length, block_offset)
+                    remote_f.write(data)
+                    progress(len(data))
+
+        self._run_sharded(journal, n_shards, transfer_range, callback)
+
+    def _run_sharded(self, journal, n_shards, transfer_range, callback):
+        lock = threading.Lock()
+        n_done = journal.bytes_done()
+
+        def progress(n_bytes):
+            nonlocal n_done
+            with lock:
+                n_done += n_bytes
+                if callback:
+                    callback(n_done, journal.size)
+
+        def shard_main(offset, length):
+            with sftp_pool.session() as sftp:
+                transfer_range(sftp, offset, length, progress)
+            with lock:
+                journal.mark_done(offset)
+
+        pending = journal.pending()
+        n_workers = max(1, min(n_shards, len(pending)))
+        with SftpPool(self, n_workers) as sftp_pool, ThreadPoolExecutor(
+            n_workers
+        ) as executor:
+            futures = [
+                executor.submit(shard_main, offset, length)
+                for offset, length in pending
+            ]
+            for future in futures:
+                future.result()
+
     def stat_file(self, remote_path: str):
         try:
             return self._get_stfp().stat(remote_path)
         except FileNotFoundError:
             return None
 
+    def utime(self, remote_path: str, times):
+        self._get_stfp().utime(remote_path, times)
+
     def listdir(self, remote_path: str, with_attrs=False) -> list:
         files = self._get_stfp().listdir_attr(remote_path)
         if not with_attrs:
@@ -135,11 +497,587 @@ class SSH:
     def remote_host(self):
         return self._connect_params["hostname"]
 
+    def ssh_command_args(self):
+        """
+        :return: arguments of the ssh command to reach the same host and user
+        """
+        params = self._connect_params
+        return ["-p", str(params["port"]), f"{params['username']}@{params['hostname']}"]
+
 
 class SshCommandError(Exception):
     pass
 
 
+class CommandTimeout(SshCommandError):
+    pass
+
+
+class RemoteStdinClosed(OSError):
+    """
+    Writing to the stdin of a remote command has failed,
+    usually because the command has exited without reading all of it.
+    """
+
+
+@dataclasses.dataclass
+class CommandResult:
+    exit_code: int
+    # tails of the output, up to max_retained bytes each
+    stdout: bytes
+    stderr: bytes
+    truncated: bool = False
+
+
+class CommandOutput:
+    """
+    Output of a running command, iterated as (stream, data) pairs where
+    stream is "stdout" or "stderr". Memory stays bounded by the chunk size
+    (or the line length), whatever amount the command prints.
+    exit_code is set once the output is exhausted.
+    """
+
+    def __init__(
+        self, chan: paramiko.Channel, wait_fn, lines=False, command="", timeout=None
+    ):
+        self._chan = chan
+        self._wait_fn = wait_fn
+        self._command = command
+        self._timeout = timeout
+        self._deadline = None if timeout is None else time.monotonic() + timeout
+        self._iter = self._iter_lines() if lines else self._iter_chunks()
+        self.exit_code = None
+
+    def __iter__(self):
+        return self._iter
+
+    def wait(self):
+        """
+        Discards the rest of the output.
+        :return: exit code
+        """
+        for _ in self._iter:
+            pass
+        return self.exit_code
+
+    def close(self):
+        self._chan.close()
+
+    def _iter_chunks(self):
+        chan = self._chan
+        while True:
+            wait_time = 1
+            if self._deadline is not None:
+                wait_time = min(wait_time, self._deadline - time.monotonic())
+                if wait_time <= 0:
+                    chan.close()
+                    raise CommandTimeout(
+                        f"{self._command} -> timed out after {self._timeout}s"
+                    )
+            if chan.recv_ready():
+                yield "stdout", chan.recv(STREAM_CHUNK_SIZE)
+            elif chan.recv_stderr_ready():
+                yield "stderr", chan.recv_stderr(STREAM_CHUNK_SIZE)
+            elif chan.eof_received or chan.closed:
+                # both streams are at EOF, but the data may have come after
+                # the checks above
+                if not chan.recv_ready() and not chan.recv_stderr_ready():
+                    break
+            else:
+                # the channel's fd becomes readable on data in either stream
+                # or EOF; the timeout only guards against a missed wakeup
+                select.select([chan], [], [], wait_time)
+        self.exit_code = self._wait_fn()
+
+    def _iter_lines(self):
+        pending = {"stdout": bytearray(), "stderr": bytearray()}
+        for stream, data in self._iter_chunks():
+            buffer = pending[stream]
+            buffer += data
+            end = buffer.rfind(b"\n") + 1
+            if end:
+                for line in bytes(buffer[:end]).split(b"\n")[:-1]:
+                    yield stream, line + b"\n"
+                del buffer[:end]
+            if len(buffer) >= MAX_LINE_LENGTH:
+                yield stream, bytes(buffer)
+                buffer.clear()
+        for stream, buffer in pending.items():
+            if buffer:
+                yield stream, bytes(buffer)
+
+
+class _OutputTail:
+    def __init__(self, max_size=None):
+        self._max_size = max_size
+        self._data = bytearray()
+        self.truncated = False
+
+    def append(self, data):
+        self._data += data
+        if self._max_size is not None and len(self._data) > self._max_size:
+            del self._data[: len(self._data) - self._max_size]
+            self.truncated = True
+
+    def getvalue(self):
+        return bytes(self._data)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_private_key(private_key_path):
+    return paramiko.RSAKey.from_private_key_file(private_key_path)
+
+
+class SSHPool:
+    """
+    Connected SSH clients kept for reuse, keyed by (host, user, key) or alike.
+    Connections are taken with checkout() and given back by leaving
+    their context manager or with checkin().
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=600):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = collections.defaultdict(list)  # key -> [(ssh, idle_since)]
+        self._n_open = collections.Counter()
+        self._n_reused = 0
+        self._n_created = 0
+        self._health = collections.defaultdict(_HostHealth)
+        self._unhealthy = set()
+
+    def checkout(self, key, factory) -> SSH:
+        """
+        :param factory: creates a new not yet connected SSH for the key
+        :return: connected SSH; blocks while max_per_host are checked out
+        """
+        while True:
+            with self._cond:
+                while not self._idle[key] and self._n_open[key] >= self.max_per_host:
+                    self._cond.wait()
+                if self._idle[key]:
+                    # the most recently used connection is the most likely alive
+                    ssh, _ = self._idle[key].pop()
+                else:
+                    ssh = None
+                    self._n_open[key] += 1
+            if ssh is None:
+                break
+            if ssh.is_alive():
+                log.debug("%r: reusing pooled connection", ssh)
+                with self._cond:
+                    self._n_reused += 1
+                return ssh
+            log.info("%r: pooled connection is dead, dropping it", ssh)
+            self.discard(ssh)
+
+        try:
+            ssh = factory()
+            ssh.start()
+        except BaseException:
+            with self._cond:
+                self._n_open[key] -= 1
+                self._cond.notify_all()
+            raise
+        ssh._pool = self
+        ssh._pool_key = key
+        with self._cond:
+            self._n_created += 1
+        return ssh
+
+    def checkin(self, ssh: SSH):
+        with self._cond:
+            is_unhealthy = id(ssh) in self._unhealthy
+        if is_unhealthy or not ssh.is_alive():
+            self.discard(ssh)
+            return
+        with self._cond:
+            self._idle[ssh._pool_key].append((ssh, time.monotonic()))
+            self._cond.notify_all()
+
+    def discard(self, ssh: SSH):
+        """
+        Closes the connection which is either checked out or was removed
+        from the idle list.
+        """
+        with self._cond:
+            idle = self._idle[ssh._pool_key]
+            idle[:] = [(conn, since) for conn, since in idle if conn is not ssh]
+            self._n_open[ssh._pool_key] -= 1
+            self._unhealthy.discard(id(ssh))
+            self._cond.notify_all()
+        ssh.stop()
+
+    def idle_connections(self) -> list:
+        with self._cond:
+            return [conn for idle in self._idle.values() for conn, _ in idle]
+
+    def report_health(self, ssh: SSH, latency=None, error=None):
+        """
+        Records the result of a health check. A failed connection is closed
+        if idle, or as soon as it's checked in otherwise.
+        """
+        with self._cond:
+            health = self._health[ssh._pool_key]
+            health.last_check_time = time.time()
+            if error is None:
+                health.last_latency = latency
+                health.n_ok += 1
+                return
+            health.n_failed += 1
+            health.last_error = str(error) or type(error).__name__
+            is_idle = any(conn is ssh for conn, _ in self._idle[ssh._pool_key])
+            if not is_idle:
+                self._unhealthy.add(id(ssh))
+        log.info("%r: health check failed: %s", ssh, health.last_error)
+        if is_idle:
+            self.discard(ssh)
+
+    def evict_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        expired = []
+        with self._cond:
+            for key, idle in self._idle.items():
+                expired.extend(conn for conn, since in idle if since < deadline)
+                idle[:] = [(conn, since) for conn, since in idle if since >= deadline]
+            for ssh in expired:
+                self._n_open[ssh._pool_key] -= 1
+            self._cond.notify_all()
+        for ssh in expired:
+            log.info("%r: closing idle connection", ssh)
+            ssh.stop()
+
+    def close(self):
+        with self._cond:
+            idle = [conn for conns in self._idle.values() for conn, _ in conns]
+            self._idle.clear()
+            for ssh in idle:
+                self._n_open[ssh._pool_key] -= 1
+            self._cond.notify_all()
+        for ssh in idle:
+            ssh.stop()
+
+    def stats(self) -> dict:
+        with self._cond:
+            hosts = {}
+            for key in set(self._n_open) | set(self._health):
+                host_stats = dict(
+                    open=self._n_open[key], idle=len(self._idle.get(key, ()))
+                )
+                host_stats.update(dataclasses.asdict(self._health[key]))
+                if isinstance(key, tuple):
+                    key = "/".join(str(part) for part in key if part is not None)
+                hosts[key] = host_stats
+            return dict(
+                open=sum(self._n_open.values()),
+                idle=sum(len(idle) for idle in self._idle.values()),
+                created=self._n_created,
+                reused=self._n_reused,
+                hosts=hosts,
+            )
+
+
+@dataclasses.dataclass
+class _HostHealth:
+    n_ok: int = 0
+    n_failed: int = 0
+    last_latency: float = None
+    last_check_time: float = None
+    last_error: str = None
+
+
+class _ChannelStdin(io.RawIOBase):
+    def __init__(self, chan: paramiko.Channel):
+        super(_ChannelStdin, self).__init__()
+        self._chan = chan
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        try:
+            self._chan.sendall(data)
+        except OSError as exc:
+            raise RemoteStdinClosed(str(exc)) from exc
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._chan.shutdown_write()
+        super(_ChannelStdin, self).close()
+
+
+def resolve_compression_level(ssh: SSH, compress, upload=False):
+    """
+    :param compress: None (no compression), gzip level or "auto" to pick
+        the level from the measured throughput
+    :param upload: the data goes to the remote host, see SSH.measure_throughput
+    :return: gzip level or None if data should go uncompressed
+    """
+    if compress != "auto":
+        return compress
+    throughput = ssh.measure_throughput(upload)
+    for max_throughput, level in COMPRESSION_LEVELS:
+        if throughput < max_throughput:
+            log.info("%r: using compression level %d", ssh, level)
+            return level
+    log.info("%r: link is fast enough, compression disabled", ssh)
+    return None
+
+
+def _as_fileobj(contents):
+    if isinstance(contents, (str, bytes)):
+        if isinstance(contents, str):
+            contents = contents.encode()
+        contents_io = io.BytesIO()
+        contents_io.write(contents)
+        contents_io.seek(0)
+        contents = contents_io
+    return contents
+
+
+def _fileobj_size(fileobj):
+    try:
+        return os.fstat(fileobj.fileno()).st_size
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    try:
+        position = fileobj.tell()
+        size = fileobj.seek(0, io.SEEK_END)
+        fileobj.seek(position)
+        return size
+    except (AttributeError, OSError):
+        return 0
+
+
+def _open_local_target(local_file):
+    """
+    :return: (file object, whether to return its contents, whether to close it)
+    """
+    if local_file is None:
+        return io.BytesIO(), True, False
+    elif isinstance(local_file, str):
+        return open(local_file, "wb"), False, True
+    else:
+        return local_file, False, False
+
+
+class _RangeJournal:
+    def __init__(self, path, size, mtime, range_size=SHARD_RANGE_SIZE, done=()):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.range_size = range_size
+        self.ranges = _split_range(0, size, range_size)
+        self.done = set(done)
+
+    @classmethod
+    def load_or_create(cls, path, size, mtime):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = None
+        if state is not None and (state["size"], state["mtime"]) == (size, mtime):
+            return cls(path, size, mtime, state["range_size"], state["done"])
+        journal = cls(path, size, mtime)
+        journal.save()
+        return journal
+
+    def pending(self):
+        return [r for r in self.ranges if r[0] not in self.done]
+
+    def bytes_done(self):
+        return sum(length for offset, length in self.ranges if offset in self.done)
+
+    def mark_done(self, offset):
+        self.done.add(offset)
+        self.save()
+
+    def save(self):
+        if self.path is None:
+            return
+        state = dict(
+            size=self.size,
+            mtime=self.mtime,
+            range_size=self.range_size,
+            done=sorted(self.done),
+        )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _split_range(offset, length, piece_size):
+    end = offset + length
+    return [
+        (piece_offset, min(piece_size, end - piece_offset))
+        for piece_offset in range(offset, end, piece_size)
+    ]
+
+
+class SftpPool:
+    """
+    Bounded set of SFTP sessions opened lazily on a single SSH transport.
+    """
+
+    def __init__(self, ssh: SSH, size: int):
+        self._ssh = ssh
+        self._size = size
+        self._n_opened = 0
+        self._idle = queue.Queue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @contextlib.contextmanager
+    def session(self):
+        with self._lock:
+            need_open = self._idle.empty() and self._n_opened < self._size
+            if need_open:
+                self._n_opened += 1
+        if need_open:
+            try:
+                sftp = self._ssh.open_sftp()
+            except BaseException:
+                with self._lock:
+                    self._n_opened -= 1
+                raise
+            with self._lock:
+                self._opened.append(sftp)
+        else:
+            sftp = self._idle.get()
+        try:
+            yield sftp
+        finally:
+            self._idle.put(sftp)
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for sftp in opened:
+            sftp.close()
+
+
+def walk_remote_files(ssh: SSH, remote_path, pattern=None, _remote_st=None):
+    """
+    Yields (relpath, remote_file_path, attrs) for every file under remote_path
+    that matches the pattern. relpath is "" when remote_path is itself a file.
+    The tree is listed with a single "find" command where the remote supports it,
+    otherwise directory by directory over SFTP.
+    :param pattern: glob for file names, or for paths relative to remote_path
+        if it contains "/"; subtrees that can't match it are not listed
+    """
+    if _remote_st is not None and not stat.S_ISDIR(_remote_st.st_mode):
+        if _pattern_matches(pattern, os.path.basename(remote_path)):
+            yield "", remote_path, _remote_st
+        return
+    try:
+        files = _list_remote_files_find(ssh, remote_path, pattern)
+    except SshCommandError:
+        log.info("%r: could not list %s with find, using SFTP", ssh, remote_path)
+        files = _walk_remote_files_sftp(ssh, remote_path, pattern, _remote_st)
+    yield from files
+
+
+def _list_remote_files_find(ssh: SSH, remote_path, pattern):
+    start_relpath = ""
+    if pattern is not None and "/" in pattern:
+        start_relpath = os.path.dirname(_pattern_literal_prefix(pattern))
+    start_path = os.path.join(remote_path, start_relpath).rstrip("/") or "/"
+    command = "find -H {} ! -type d".format(shlex.quote(start_path))
+    if pattern is not None and "/" not in pattern:
+        command += " -name " + shlex.quote(pattern)
+    command += " -printf '%y %s %m %T@ %P\\0'"
+    output = ssh.cmd(command)
+
+    files = []
+    for entry in output.decode("utf-8", "surrogateescape").split("\0")[:-1]:
+        ftype, size, mode, mtime, relpath = entry.split(" ", 4)
+        if relpath == "":
+            # find was started on a file
+            if start_relpath or not _pattern_matches(pattern, remote_path):
+                continue
+            file_path = remote_path
+        else:
+            relpath = os.path.join(start_relpath, relpath) if start_relpath else relpath
+            if not _pattern_matches(pattern, relpath):
+                continue
+            file_path = os.path.join(remote_path, relpath)
+        attrs = paramiko.SFTPAttributes()
+        attrs.filename = os.path.basename(file_path)
+        attrs.st_size = int(size)
+        attrs.st_mode = _FIND_FILE_TYPES.get(ftype, stat.S_IFREG) | int(mode, 8)
+        attrs.st_mtime = int(float(mtime))
+        files.append((relpath, file_path, attrs))
+    return files
+
+
+_FIND_FILE_TYPES = {
+    "f": stat.S_IFREG,
+    "l": stat.S_IFLNK,
+    "p": stat.S_IFIFO,
+    "s": stat.S_IFSOCK,
+    "c": stat.S_IFCHR,
+    "b": stat.S_IFBLK,
+}
+
+
+def _walk_remote_files_sftp(ssh: SSH, remote_path, pattern, remote_st=None):
+    if remote_st is None:
+        remote_st = ssh.stat_file(remote_path)
+    if remote_st is None:
+        raise FileNotFoundError(remote_path)
+    if stat.S_ISDIR(remote_st.st_mode):
+        yield from _walk_remote_dir_sftp(ssh, remote_path, "", pattern)
+    elif _pattern_matches(pattern, os.path.basename(remote_path)):
+        yield "", remote_path, remote_st
+
+
+def _walk_remote_dir_sftp(ssh: SSH, dir_path, dir_relpath, pattern):
+    for fattr in ssh.listdir(dir_path, with_attrs=True):
+        path = os.path.join(dir_path, fattr.filename)
+        relpath = os.path.join(dir_relpath, fattr.filename)
+        if stat.S_ISDIR(fattr.st_mode):
+            if _pattern_may_match_under(pattern, relpath):
+                yield from _walk_remote_dir_sftp(ssh, path, relpath, pattern)
+        elif _pattern_matches(pattern, relpath):
+            yield relpath, path, fattr
+
+
+def _pattern_matches(pattern, relpath):
+    if pattern is None:
+        return True
+    if "/" not in pattern:
+        relpath = os.path.basename(relpath)
+    return fnmatch.fnmatch(relpath, pattern)
+
+
+def _pattern_may_match_under(pattern, dir_relpath):
+    if pattern is None or "/" not in pattern:
+        return True
+    prefix = _pattern_literal_prefix(pattern)
+    dir_prefix = dir_relpath + "/"
+    return dir_prefix.startswith(prefix) or prefix.startswith(dir_prefix)
+
+
+def _pattern_literal_prefix(pattern):
+    for i, char in enumerate(pattern):
+        if char in "*?[":
+            return pattern[:i]
+    return pattern
+
+
 def download_file_or_directory(
     ssh: SSH,
     remote_path,
@@ -147,68 +1085,408 @@ def download_file_or_directory(
     callback=None,
     skip_existing=False,
     pattern=None,
-    _remote_st=None,
-    _relpath="",
+    jobs=1,
+    shards=1,
+    sync=False,
+    compress=None,
 ):
-    if _remote_st is None:
-        _remote_st = ssh.stat_file(remote_path)
-    if _remote_st is None:
-        raise FileNotFoundError(remote_path)
-    if stat.S_ISDIR(_remote_st.st_mode):
-        fileattrs = ssh.listdir(remote_path, with_attrs=True)
-        for fattr in fileattrs:
-            download_file_or_directory(
-                ssh,
-                os.path.join(remote_path, fattr.filename),
-                os.path.join(local_path, fattr.filename),
-                callback,
-                skip_existing=skip_existing,
-                pattern=pattern,
-                _remote_st=fattr,
-                _relpath=os.path.join(_relpath, fattr.filename),
+    """
+    :param compress: see resolve_compression_level
+    :param sync: transfer only files that differ by size and mtime, or by
+        contents when size matches but mtime does not; transferred files get
+        the remote mtime
+    """
+    tasks = []
+    sync_entries = []
+    for relpath, remote_file, attrs in walk_remote_files(ssh, remote_path, pattern):
+        local_file = os.path.join(local_path, relpath) if relpath else local_path
+        is_partial = os.path.exists(local_file + PARTIAL_SUFFIX)
+        if skip_existing and os.path.exists(local_file) and not is_partial:
+            log.info(
+                f'skip remote file "{remote_file}" '
+                f'- already exists locally at "{local_file}"'
             )
-    else:
+            continue
+        n_shards = shards if attrs.st_size >= SHARDED_MIN_FILE_SIZE else 1
+        mtime = attrs.st_mtime if sync else None
+        task = (relpath, remote_file, local_file, n_shards, mtime)
+        tasks.append(task)
+        if sync:
+            local_st = None if is_partial else _local_stat(local_file)
+            sync_entries.append((task, local_file, local_st, remote_file, attrs))
 
-        if pattern is not None:
-            remote_name = os.path.basename(remote_path)
-            if not fnmatch.fnmatch(remote_name, pattern):
-                return
+    if sync:
+        tasks = _select_changed(ssh, sync_entries, src_is_remote=True)
+    level = resolve_compression_level(ssh, compress) if tasks else None
+    tasks = [task + (level,) for task in tasks]
 
-        if skip_existing and os.path.exists(local_path):
-            log.info(
-                f'skip remote file "{remote_path}" '
-                f'- already exists locally at "{local_path}"'
-            )
-            return
+    if jobs > 1 and len(tasks) > 1:
+        with SftpPool(ssh, jobs) as sftp_pool, ThreadPoolExecutor(jobs) as executor:
+            futures = [
+                executor.submit(_download_one, ssh, *task, callback, sftp_pool)
+                for task in tasks
+            ]
+            for future in futures:
+                future.result()
+    else:
+        for task in tasks:
+            _download_one(ssh, *task, callback)
 
-        def wrap_callback(n_done, n_total):
-            if callback:
-                callback(_relpath, n_done, n_total)
 
-        local_dir = os.path.dirname(local_path)
-        if local_dir != "":
-            os.makedirs(local_dir, exist_ok=True)
+def _download_one(
+    ssh: SSH,
+    relpath,
+    remote_path,
+    local_path,
+    n_shards,
+    mtime,
+    level,
+    callback,
+    sftp_pool=None,
+):
+    def wrap_callback(n_done, n_total):
+        if callback:
+            callback(relpath, n_done, n_total)
+
+    local_dir = os.path.dirname(local_path)
+    if local_dir != "":
+        os.makedirs(local_dir, exist_ok=True)
+    if n_shards > 1:
+        ssh.download_file_sharded(remote_path, local_path, n_shards, wrap_callback)
+    elif level is not None:
+        ssh.download_file_compressed(remote_path, local_path, wrap_callback, level)
+    elif sftp_pool is None:
         ssh.download_file(remote_path, local_path, wrap_callback)
+    else:
+        with sftp_pool.session() as sftp:
+            ssh.download_file(remote_path, local_path, wrap_callback, sftp=sftp)
+    if mtime is not None:
+        os.utime(local_path, (os.stat(local_path).st_atime, mtime))
 
 
-def upload_file_or_directory(ssh: SSH, local_path, remote_path, callback=None):
+def upload_file_or_directory(
+    ssh: SSH,
+    local_path,
+    remote_path,
+    callback=None,
+    shards=1,
+    sync=False,
+    compress=None,
+):
+    """
+    :param sync, compress: see download_file_or_directory
+    """
+    level = resolve_compression_level(ssh, compress, upload=True)
+
     def wrap_callback(n_done, n_total):
         if callback:
             callback(display_path, n_done, n_total)
 
+    def send(file_path, remote_file_path):
+        if shards > 1 and os.path.getsize(file_path) >= SHARDED_MIN_FILE_SIZE:
+            ssh.send_file_sharded(remote_file_path, file_path, shards, wrap_callback)
+        elif level is not None:
+            with open(file_path, "rb") as f:
+                ssh.send_file_compressed(remote_file_path, f, wrap_callback, level)
+        else:
+            with open(file_path, "rb") as f:
+                ssh.send_file(remote_file_path, f, wrap_callback)
+        if sync:
+            local_st = os.stat(file_path)
+            ssh.utime(remote_file_path, (local_st.st_atime, local_st.st_mtime))
+
     if os.path.isdir(local_path):
-        for parentdir, dirs, files in os.walk(local_path):
+        dir_relpaths = []
+        files = []
+        for parentdir, dirs, fnames in os.walk(local_path):
             dir_relpath = os.path.relpath(parentdir, local_path)
             if dir_relpath == ".":
                 dir_relpath = ""
-            ssh.cmd("mkdir " + os.path.join(remote_path, dir_relpath))
-            for fname in files:
+            dir_relpaths.append(dir_relpath)
+            for fname in fnames:
                 file_path = os.path.join(parentdir, fname)
-                relpath = os.path.relpath(file_path, local_path)
-                display_path = file_path
-                with open(file_path, "rb") as f:
-                    ssh.send_file(os.path.join(remote_path, relpath), f, wrap_callback)
+                files.append((os.path.relpath(file_path, local_path), file_path))
+        if sync:
+            files = _select_changed_uploads(ssh, files, remote_path)
+        make_remote_dirs(
+            ssh, [os.path.join(remote_path, relpath) for relpath in dir_relpaths]
+        )
+        for relpath, file_path in files:
+            display_path = file_path
+            send(file_path, os.path.join(remote_path, relpath))
     else:
         display_path = local_path
-        with open(local_path, "rb") as f:
-            ssh.send_file(remote_path, f, wrap_callback)
+        files = [("", local_path)]
+        if sync:
+            files = _select_changed_uploads(ssh, files, remote_path)
+        if files:
+            send(local_path, remote_path)
+
+
+def make_remote_dirs(ssh: SSH, remote_dirs):
+    """
+    Creates all the directories (with parents, tolerating existing ones)
+    in one remote command.
+    """
+    remote_dirs = [path.rstrip("/") or "/" for path in remote_dirs]
+    # parents are created by mkdir -p anyway, pass only the deepest directories
+    ancestors = set()
+    for path in remote_dirs:
+        parent = os.path.dirname(path)
+        while parent not in ("", "/") and parent not in ancestors:
+            ancestors.add(parent)
+            parent = os.path.dirname(parent)
+    leaves = set(remote_dirs) - ancestors
+    if not leaves:
+        return
+    names = b"".join(path.encode() + b"\0" for path in sorted(leaves))
+    ssh.cmd_input("xargs -0 mkdir -p --", names)
+
+
+def _select_changed_uploads(ssh: SSH, files, remote_path):
+    remote_attrs = {}
+    remote_st = ssh.stat_file(remote_path)
+    if remote_st is not None:
+        for relpath, _, attrs in walk_remote_files(
+            ssh, remote_path, _remote_st=remote_st
+        ):
+            remote_attrs[relpath] = attrs
+    entries = []
+    for relpath, file_path in files:
+        remote_file = os.path.join(remote_path, relpath) if relpath else remote_path
+        entries.append(
+            (
+                (relpath, file_path),
+                file_path,
+                os.stat(file_path),
+                remote_file,
+                remote_attrs.get(relpath),
+            )
+        )
+    return _select_changed(ssh, entries, src_is_remote=False)
+
+
+def _select_changed(ssh: SSH, entries, src_is_remote):
+    """
+    Keeps the entries whose source and destination differ. Files of equal size
+    and mtime are considered the same, files of equal size but different mtime
+    are compared by content hashes, all remote ones computed in one command.
+    :param entries: list of (item, local_file, local_st, remote_file, remote_st),
+        stats are None for missing files
+    :return: list of items
+    """
+    changed = set()
+    ambiguous = []
+    for i, (item, local_file, local_st, remote_file, remote_st) in enumerate(entries):
+        if src_is_remote:
+            src_st, dst_st = remote_st, local_st
+        else:
+            src_st, dst_st = local_st, remote_st
+        if dst_st is None or dst_st.st_size != src_st.st_size:
+            changed.add(i)
+        elif int(dst_st.st_mtime) != int(src_st.st_mtime):
+            ambiguous.append(i)
+
+    if ambiguous:
+        remote_hashes = remote_sha256(ssh, [entries[i][3] for i in ambiguous])
+        for i in ambiguous:
+            item, local_file, local_st, remote_file, remote_st = entries[i]
+            if local_sha256(local_file) != remote_hashes.get(remote_file):
+                changed.add(i)
+            elif src_is_remote:
+                os.utime(local_file, (local_st.st_atime, remote_st.st_mtime))
+            else:
+                ssh.utime(remote_file, (remote_st.st_atime, local_st.st_mtime))
+
+    for i, entry in enumerate(entries):
+        if i not in changed:
+            log.info(f'skip "{entry[1]}" - up to date with "{entry[3]}"')
+    return [entry[0] for i, entry in enumerate(entries) if i in changed]
+
+
+def remote_sha256(ssh: SSH, remote_paths) -> dict:
+    """
+    :return: mapping of remote path to hex digest, computed in a single command
+    """
+    names = b"".join(path.encode() + b"\0" for path in remote_paths)
+    output = ssh.cmd_input("xargs -0 sha256sum --", names)
+    hashes = {}
+    for line in output.decode().splitlines():
+        digest, _, path = line.partition("  ")
+        # sha256sum escapes unusual file names; those are reported as changed
+        if not digest.startswith("\\"):
+            hashes[path] = digest
+    return hashes
+
+
+def local_sha256(local_path) -> str:
+    sha = hashlib.sha256()
+    with open(local_path, "rb") as f:
+        for block in iter(lambda: f.read(SHARD_BLOCK_SIZE), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _local_stat(local_path):
+    try:
+        return os.stat(local_path)
+    except FileNotFoundError:
+        return None
+
+
+def download_tar(
+    ssh: SSH, remote_path, local_path, callback=None, skip_existing=False, pattern=None
+):
+    """
+    Downloads the file or directory as a single tar stream over one exec channel,
+    instead of a few SFTP round trips per file.
+    """
+    base_dir, base_name = os.path.split(remote_path.rstrip("/"))
+    member_names = []
+    n_total = 0
+    for relpath, remote_file, attrs in walk_remote_files(ssh, remote_path, pattern):
+        local_file = os.path.join(local_path, relpath) if relpath else local_path
+        if skip_existing and os.path.exists(local_file):
+            log.info(
+                f'skip remote file "{remote_file}" '
+                f'- already exists locally at "{local_file}"'
+            )
+            continue
+        member_names.append(os.path.join(base_name, relpath) if relpath else base_name)
+        n_total += attrs.st_size
+    if not member_names:
+        return
+
+    command = "tar -c -f - --null --no-recursion -C {} -T -".format(
+        shlex.quote(base_dir or ".")
+    )
+    wait_fn, stdin, stdout, stderr = ssh.cmd_stream_stdin(command)
+
+    def send_member_names():
+        with stdin:
+            for name in member_names:
+                stdin.write(name.encode() + b"\0")
+
+    names_thread = threading.Thread(target=send_member_names, daemon=True)
+    names_thread.start()
+
+    progress = _AggregateProgress(base_name, n_total, callback)
+    with tarfile.open(fileobj=stdout, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            relpath = _tar_member_relpath(member.name, base_name)
+            local_file = os.path.join(local_path, relpath) if relpath else local_path
+            local_dir = os.path.dirname(local_file)
+            if local_dir != "":
+                os.makedirs(local_dir, exist_ok=True)
+            with open(local_file, "wb") as f:
+                _copy_with_progress(tar.extractfile(member), f, progress)
+    stdout.read()
+    names_thread.join()
+    errors = stderr.read().decode()
+    rc = wait_fn()
+    if rc != 0:
+        raise SshCommandError(f"{command} -> exited with {rc}: {errors}")
+
+
+def upload_tar(
+    ssh: SSH, local_path, remote_path, callback=None, skip_existing=False, pattern=None
+):
+    """
+    Uploads the file or directory as a single tar stream over one exec channel.
+    """
+    if os.path.isdir(local_path):
+        extract_dir = remote_path
+        files = []
+        for parentdir, dirs, fnames in os.walk(local_path):
+            for fname in fnames:
+                file_path = os.path.join(parentdir, fname)
+                files.append((os.path.relpath(file_path, local_path), file_path))
+    else:
+        extract_dir, remote_name = os.path.split(remote_path)
+        files = [(remote_name, local_path)]
+    if pattern is not None:
+        files = [
+            (relpath, file_path)
+            for relpath, file_path in files
+            if _pattern_matches(pattern, relpath)
+        ]
+    if skip_existing:
+        existing = set()
+        remote_st = ssh.stat_file(remote_path)
+        if remote_st is not None:
+            for relpath, remote_file, _ in walk_remote_files(
+                ssh, remote_path, _remote_st=remote_st
+            ):
+                existing.add(os.path.relpath(remote_file, extract_dir))
+        for relpath, file_path in files:
+            if relpath in existing:
+                log.info(
+                    f'skip local file "{file_path}" '
+                    f'- already exists remotely at "{remote_path}"'
+                )
+        files = [(relpath, fp) for relpath, fp in files if relpath not in existing]
+    if not files:
+        return
+
+    n_total = sum(os.path.getsize(file_path) for _, file_path in files)
+    progress = _AggregateProgress(local_path, n_total, callback)
+    command = "mkdir -p {0} && tar -x -f - -C {0}".format(
+        shlex.quote(extract_dir or ".")
+    )
+    wait_fn, stdin, stdout, stderr = ssh.cmd_stream_stdin(command)
+    try:
+        with stdin, tarfile.open(fileobj=stdin, mode="w|") as tar:
+            for relpath, file_path in files:
+                tarinfo = tar.gettarinfo(file_path, arcname=relpath)
+                with open(file_path, "rb") as f:
+                    tar.addfile(tarinfo, _ProgressReader(f, progress))
+    except RemoteStdinClosed:
+        # remote tar has exited prematurely, its error is reported below
+        log.debug("%r: tar stream interrupted", ssh, exc_info=True)
+    stdout.read()
+    errors = stderr.read().decode()
+    rc = wait_fn()
+    if rc != 0:
+        raise SshCommandError(f"{command} -> exited with {rc}: {errors}")
+
+
+class _AggregateProgress:
+    def __init__(self, display_name, n_total, callback):
+        self._display_name = display_name
+        self._n_total = n_total
+        self._callback = callback
+        self._n_done = 0
+
+    def __call__(self, n_bytes):
+        self._n_done += n_bytes
+        if self._callback:
+            self._callback(self._display_name, self._n_done, self._n_total)
+
+
+class _ProgressReader:
+    def __init__(self, fileobj, progress):
+        self._fileobj = fileobj
+        self._progress = progress
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self._progress(len(data))
+        return data
+
+
+def _copy_with_progress(src, dst, progress, block_size=SHARD_BLOCK_SIZE):
+    while True:
+        data = src.read(block_size)
+        if not data:
+            break
+        dst.write(data)
+        progress(len(data))
+
+
+def _tar_member_relpath(member_name, base_name):
+    parts = member_name.split("/")
+    if parts[0] != base_name or ".." in parts:
+        raise SshCommandError(f"unexpected path in remote tar stream: {member_name}")
+    return "/".join(parts[1:])
@@ -5,13 +5,19 @@ def interface_ssh():
     cli = argparse.ArgumentParser()
     cli.add_argument("server", nargs="?")
     cli.add_argument("--config", "-C", default=".aqx.ini")
+    cli.add_argument(
+        "--no-multiplex",
+        dest="multiplex",
+        action="store_false",
+        help="don't share a master connection with other sessions to the server",
+    )
 
     def call(opts, execution_service):
         from aqx.tools import ssh
         from aqx.core import AppService
 
         app = AppService(opts.config)
-        return ssh.main(app, opts.server)
+        return ssh.main(app, opts.server, multiplex=opts.multiplex)
 
     return cli, call
 
@@ -21,7 +27,44 @@ def interface_filetransfer():
     cli.add_argument("server", nargs="?")
     cli.add_argument("--config", "-C", default=".aqx.ini")
     cli.add_argument("--skip-existing", action="store_true")
-    cli.add_argument("--pattern")
+    cli.add_argument(
+        "--pattern",
+        help="glob for file names, or for relative paths if it contains '/'",
+    )
+    cli.add_argument(
+        "--sync",
+        action="store_true",
+        help="transfer only files that differ by size, mtime or checksum",
+    )
+    cli.add_argument(
+        "--jobs", "-j", type=int, default=1, help="parallel SFTP sessions for get"
+    )
+    cli.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="split large files into byte ranges moved over parallel SFTP sessions",
+    )
+    cli.add_argument(
+        "--engine",
+        choices=["sftp", "tar"],
+        default="sftp",
+        help="tar streams the whole tree through a single remote command",
+    )
+    _add_compress_argument(cli)
+    cli.add_argument(
+        "--relay-to",
+        action="append",
+        default=[],
+        metavar="SERVER",
+        help="put to this server too, forwarding the data from server to server",
+    )
+    cli.add_argument(
+        "--fanout",
+        type=int,
+        default=2,
+        help="servers each relaying server (and this machine) sends to; 1 is a chain",
+    )
     cli.add_argument("direction", choices=["get", "put"])
     cli.add_argument("file1")
     cli.add_argument("file2", nargs="?")
@@ -30,11 +73,41 @@ def interface_filetransfer():
         from aqx.tools import filetransfer
         from aqx.core import AppService
 
-        app = AppService(opts.config)
+        app = AppService(
+            opts.config, execution_service.ssh_pool, execution_service.session_limit
+        )
         if opts.file2 is None:
             opts.file2 = opts.file1
-        if opts.skip_existing and opts.direction != "get":
-            cli.error("--skip-existing is only supported for direction=get")
+        if opts.skip_existing and opts.direction != "get" and opts.engine != "tar":
+            cli.error(
+                "--skip-existing is only supported for direction=get or engine=tar"
+            )
+        if opts.jobs < 1:
+            cli.error("--jobs must be positive")
+        if opts.shards < 1:
+            cli.error("--shards must be positive")
+        if opts.jobs > 1 and opts.direction != "get":
+            cli.error("--jobs is only supported for direction=get")
+        if opts.engine == "tar" and (opts.jobs > 1 or opts.shards > 1):
+            cli.error("--jobs and --shards are not supported for engine=tar")
+        if opts.sync and (opts.skip_existing or opts.engine == "tar"):
+            cli.error("--sync can't be combined with --skip-existing or engine=tar")
+        if opts.compress is not None and (opts.shards > 1 or opts.engine == "tar"):
+            cli.error("--compress can't be combined with --shards or engine=tar")
+        if opts.fanout < 1:
+            cli.error("--fanout must be positive")
+        if opts.relay_to and (
+            opts.direction != "put"
+            or opts.skip_existing
+            or opts.sync
+            or opts.pattern is not None
+            or opts.shards > 1
+            or opts.compress is not None
+        ):
+            cli.error(
+                "--relay-to is only supported for direction=put without "
+                "--skip-existing, --sync, --pattern, --shards and --compress"
+            )
         return filetransfer.main(
             app,
             opts.server,
@@ -43,6 +116,13 @@ def interface_filetransfer():
             opts.file2,
             skip_existing=opts.skip_existing,
             pattern=opts.pattern,
+            jobs=opts.jobs,
+            shards=opts.shards,
+            engine=opts.engine,
+            sync=opts.sync,
+            compress=opts.compress,
+            relay_to=opts.relay_to,
+            fanout=opts.fanout,
         )
 
     return cli, call
@@ -52,13 +132,109 @@ def interface_deploy():
     cli = argparse.ArgumentParser()
     cli.add_argument("servers", nargs="+")
     cli.add_argument("--config", "-C", default=".aqx.ini")
+    _add_compress_argument(cli)
+    cli.add_argument(
+        "--parallel", "-p", type=int, default=8, help="servers deployed at once"
+    )
+    waves = cli.add_mutually_exclusive_group()
+    waves.add_argument("--batch-size", type=int, help="servers per rollout wave")
+    waves.add_argument("--waves", type=int, help="split the rollout into N waves")
+    cli.add_argument(
+        "--max-failures",
+        type=int,
+        metavar="N",
+        help="stop the rollout once more than N servers have failed",
+    )
+    cli.add_argument(
+        "--pipelined",
+        action="store_true",
+        help="deploy each server with a single remote command, patch sent on stdin",
+    )
+    cli.add_argument(
+        "--no-patch-cache",
+        dest="patch_cache",
+        action="store_false",
+        help="don't keep patches on the servers to skip or shrink re-uploads",
+    )
+    cli.add_argument(
+        "--no-bundle",
+        dest="bundle",
+        action="store_false",
+        help="update servers at other commits with git pull "
+        "rather than with bundles sent from here",
+    )
+    cli.add_argument(
+        "--relay-fanout",
+        type=int,
+        metavar="N",
+        help="send the patch from here to N servers only, "
+        "each server forwards it to N more",
+    )
 
     def call(opts, execution_service):
         from aqx.tools import deploy
         from aqx.core import AppService
 
-        app = AppService(opts.config)
-        return deploy.main(app, opts.servers)
+        for name in ["parallel", "batch_size", "waves", "relay_fanout"]:
+            value = getattr(opts, name)
+            if value is not None and value < 1:
+                cli.error(f"--{name.replace('_', '-')} must be positive")
+        if opts.max_failures is not None and opts.max_failures < 0:
+            cli.error("--max-failures can't be negative")
+        app = AppService(
+            opts.config, execution_service.ssh_pool, execution_service.session_limit
+        )
+        return deploy.main(
+            app,
+            opts.servers,
+            compress=opts.compress,
+            parallel=opts.parallel,
+            batch_size=opts.batch_size,
+            waves=opts.waves,
+            max_failures=opts.max_failures,
+            pipelined=opts.pipelined,
+            use_patch_cache=opts.patch_cache,
+            use_bundles=opts.bundle,
+            relay_fanout=opts.relay_fanout,
+        )
+
+    return cli, call
+
+
+def interface_exec():
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--config", "-C", default=".aqx.ini")
+    cli.add_argument(
+        "--parallel", "-p", type=int, default=32, help="servers run at once"
+    )
+    cli.add_argument(
+        "--timeout",
+        "-t",
+        type=float,
+        metavar="SECONDS",
+        help="give up on a server whose command runs longer",
+    )
+    cli.add_argument("command", help="shell command to run on each server")
+    cli.add_argument("servers", nargs="+")
+
+    def call(opts, execution_service):
+        from aqx.tools import execute
+        from aqx.core import AppService
+
+        if opts.parallel < 1:
+            cli.error("--parallel must be positive")
+        if opts.timeout is not None and opts.timeout <= 0:
+            cli.error("--timeout must be positive")
+        app = AppService(
+            opts.config, execution_service.ssh_pool, execution_service.session_limit
+        )
+        return execute.main(
+            app,
+            opts.servers,
+            opts.command,
+            parallel=opts.parallel,
+            timeout=opts.timeout,
+        )
 
     return cli, call
 
@@ -79,6 +255,74 @@ def interface_openserver():
     return cli, call
 
 
+def interface_status():
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--json", action="store_true", help="print raw stats as JSON")
+
+    def call(opts, execution_service):
+        import json
+        from aqx.core import current_client
+
+        stats = execution_service.stats()
+        out = current_client().stdout
+        if opts.json:
+            print(json.dumps(stats, indent=2, sort_keys=True), file=out)
+            return
+        sched = stats["scheduler"]
+        print(
+            f"requests: {sched['running']} running, {sched['queued']} queued "
+            f"(oldest {sched['oldest_queued_age']:.1f}s), "
+            f"{sched['admitted']} admitted, {sched['rejected']} rejected",
+            file=out,
+        )
+        print(
+            f"queue wait: avg {sched['wait_avg']:.2f}s, "
+            f"p95 {sched['wait_p95']:.2f}s, max {sched['wait_max']:.2f}s",
+            file=out,
+        )
+        for host, host_stats in sorted(sched["hosts"].items()):
+            print(
+                f"  {host}: {host_stats['running']} running, "
+                f"{host_stats['queued']} queued",
+                file=out,
+            )
+        sessions = stats["sessions"]
+        if sessions is not None:
+            print(
+                f"host sessions: {sessions['active']} of {sessions['max_sessions']} "
+                f"active, {sessions['waiting']} waiting",
+                file=out,
+            )
+        pool = stats["ssh_pool"]
+        print(
+            f"ssh connections: {pool['open']} open, {pool['idle']} idle, "
+            f"{pool['created']} created, {pool['reused']} reused",
+            file=out,
+        )
+
+    return cli, call
+
+
+def _add_compress_argument(cli):
+    def compression_level(value):
+        if value == "auto":
+            return value
+        level = int(value)
+        if not 1 <= level <= 9:
+            raise ValueError(value)
+        return level
+
+    cli.add_argument(
+        "--compress",
+        nargs="?",
+        const="auto",
+        type=compression_level,
+        metavar="LEVEL",
+        help="gzip data on the wire, level 1-9 or 'auto' (default) "
+        "to choose by measured throughput",
+    )
+
+
 def _run_main(cli, func, argv):
     opts = cli.parse_args(argv)
 
@@ -1,18 +1,23 @@
 #!/usr/bin/env python
 
+import gzip
+import shlex
+import contextlib
 import subprocess
 import logging
 import threading
 from typing import Optional
-from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from aqx import sshlib, core
+from aqx.patchcache import PatchCache
 
 
 log = logging.getLogger("deploy")
 
 
-def get_local_git_commit():
-    gh = subprocess.check_output("git rev-parse HEAD", shell=True).decode().strip()
+def get_local_git_commit(cwd=None):
+    gh = subprocess.check_output("git rev-parse HEAD", shell=True, cwd=cwd)
+    gh = gh.decode().strip()
     log.info("Local git hash: %s", gh)
     return gh
 
@@ -24,20 +29,30 @@ def get_remote_git_commit(client: sshlib.SSH, remote_dir: str):
     return gh
 
 
-def generate_patch():
+def generate_patch(cwd=None):
     log.info("generating patch...")
     try:
-        return subprocess.check_output("git diff HEAD", shell=True)
+        return subprocess.check_output("git diff HEAD", shell=True, cwd=cwd)
     finally:
         log.info("patch generated")
 
 
-def send_patch(client: sshlib.SSH, patch_f):
+def send_patch(client: sshlib.SSH, patch_f, compress=None, patch_cache=None):
+    """
+    :param patch_cache: PatchCache to keep the patch in on the remote side;
+        otherwise it goes to a temp file to be removed with cleanup_patch_on_remote
+    """
     patch_contents: bytes = patch_f.result()
+    if patch_contents and patch_cache is not None:
+        return patch_cache.ensure_remote(client, patch_contents, compress)
     if patch_contents:
         log.info("%s: sending patch contents...", client)
         rem_temp_file = client.cmd("mktemp").decode().strip()
-        client.send_file(rem_temp_file, patch_contents)
+        level = sshlib.resolve_compression_level(client, compress, upload=True)
+        if level is None:
+            client.send_file(rem_temp_file, patch_contents)
+        else:
+            client.send_file_compressed(rem_temp_file, patch_contents, level=level)
         return rem_temp_file
 
 
@@ -63,10 +78,96 @@ def freshen_remote(client: sshlib.SSH, remote_dir: str):
     client.cmd(f"cd {remote_dir}; git pull")
 
 
-def deploy_one_server(app, server, local_commit_f, patch_f):
+# $1 - remote dir, $2 - commit to reset to, with a bundle of the missing objects
+# on stdin (empty if there are none)
+FETCH_BUNDLE_SCRIPT = """\
+set -e
+cd "$1"
+bundle=$(mktemp)
+trap 'rm -f "$bundle"' EXIT
+cat > "$bundle"
+if [ -s "$bundle" ]; then
+    git fetch -q "$bundle" HEAD
+fi
+git reset -q --hard "$2"
+"""
+
+
+def freshen_remote_from_bundle(
+    client: sshlib.SSH, remote_dir: str, remote_commit, local_commit, bundles
+):
+    """
+    Brings the remote to the local commit by sending it the objects it lacks,
+    without it having to pull from the central Git server.
+    :param bundles: BundleBuilder shared between the servers
+    :return: False if the remote commit isn't known locally, so a pull is needed
+    """
+    bundle = bundles.get(remote_commit)
+    if bundle is None:
+        return False
+    log.info(
+        "%s: Freshen remote's code with %d bytes git bundle...", client, len(bundle)
+    )
+    command = " ".join(
+        shlex.quote(arg)
+        for arg in ["sh", "-c", FETCH_BUNDLE_SCRIPT, "aqx-deploy"]
+        + [remote_dir, local_commit]
+    )
+    client.cmd_input(command, bundle)
+    return True
+
+
+class BundleBuilder:
+    """
+    Git bundles from the commits servers are at to the local HEAD,
+    built once per distinct commit however many servers are at it.
+    """
+
+    def __init__(self, cwd=None):
+        self._cwd = cwd
+        self._lock = threading.Lock()
+        self._bundles = {}
+
+    def get(self, base_commit) -> Optional[bytes]:
+        """
+        :return: the bundle, empty if the base has nothing to add to,
+            or None if the base commit isn't known locally
+        """
+        with self._lock:
+            if base_commit not in self._bundles:
+                self._bundles[base_commit] = self._build(base_commit)
+            return self._bundles[base_commit]
+
+    def _build(self, base_commit):
+        def git(*args, **kwargs):
+            return subprocess.run(
+                ["git", *args], cwd=self._cwd, stdout=subprocess.PIPE, **kwargs
+            )
+
+        if git("cat-file", "-e", base_commit + "^{commit}").returncode != 0:
+            log.info("commit %s is unknown locally, can't bundle from it", base_commit)
+            return None
+        if git("merge-base", "--is-ancestor", "HEAD", base_commit).returncode == 0:
+            # the base already has everything, only the reset is needed
+            return b""
+        bundle = git("bundle", "create", "-", "HEAD", "^" + base_commit, check=True)
+        log.info("built git bundle from %s: %d bytes", base_commit, len(bundle.stdout))
+        return bundle.stdout
+
+
+def deploy_one_server(
+    app,
+    executor,
+    server,
+    local_commit_f,
+    patch_f,
+    compress=None,
+    patch_cache=None,
+    bundles=None,
+):
     server = app.maybe_resolve_host_alias(server)
     log.info("Deploying to server %s...", server)
-    ssh_conn = app.get_host(server).make_ssh_connection()
+    ssh_conn = app.make_ssh_connection(server)
     log.info("%s: connection=%s", server, ssh_conn)
     remote_path = ssh_conn.home_dir
 
@@ -74,56 +175,307 @@ def deploy_one_server(app, server, local_commit_f, patch_f):
         # send the patch in advance
         # even if later we'll find that git hashes are not OK, we more win than lose
         # because usually they're OK, so we save few additional seconds
-        remote_patch_file_f = _acall(send_patch, ssh_conn, patch_f)
+        remote_patch_file_f = _acall(
+            executor, send_patch, ssh_conn, patch_f, compress, patch_cache
+        )
 
-        # while patch is sending, check the git hashes
-        remote_commit = get_remote_git_commit(ssh_conn, remote_path)
-        local_commit = local_commit_f.result()
-        if local_commit != remote_commit:
-            freshen_remote(ssh_conn, remote_path)
+        try:
+            # while patch is sending, check the git hashes
             remote_commit = get_remote_git_commit(ssh_conn, remote_path)
+            local_commit = local_commit_f.result()
+            if local_commit != remote_commit:
+                _freshen(ssh_conn, remote_path, remote_commit, local_commit, bundles)
+                remote_commit = get_remote_git_commit(ssh_conn, remote_path)
+        finally:
+            # the connection goes back to the pool when we leave the block,
+            # it must not be in use by send_patch by then
+            wait([remote_patch_file_f])
 
         remote_patch_file = remote_patch_file_f.result()
         # now patch is sent, so we can install it if everything is fine
         if local_commit == remote_commit:
             deploy_patch(ssh_conn, remote_path, remote_patch_file)
+        if patch_cache is None:
             cleanup_patch_on_remote(ssh_conn, remote_patch_file)
-        else:
-            cleanup_patch_on_remote(ssh_conn, remote_patch_file)
+        if local_commit != remote_commit:
             raise RevisionMismatchError
     log.info("%s: done", server)
 
 
-def main(app: core.AppService, servers):
-    local_commit_f = _acall(get_local_git_commit)
-    patch_f = _acall(generate_patch)
-    deploy_fs = [
-        _acall(deploy_one_server, app, server, local_commit_f, patch_f)
-        for server in servers
-    ]
-    for server, deploy_f in zip(servers, deploy_fs):
-        try:
-            deploy_f.result()
-        except RevisionMismatchError:
-            log.error("%s: Git versions do not match", server)
-        except:
-            log.exception("%s")
+def _freshen(ssh_conn, remote_path, remote_commit, local_commit, bundles):
+    if bundles is None or not freshen_remote_from_bundle(
+        ssh_conn, remote_path, remote_commit, local_commit, bundles
+    ):
+        freshen_remote(ssh_conn, remote_path)
 
 
-def _acall(function, *args, **kwargs):
-    future = Future()
+# bigger patches are sent through PatchCache in the pipelined mode,
+# smaller ones are cheaper to stream with the script than to look up
+PATCH_INLINE_MAX_SIZE = 64 * 1024
 
-    def function_call_main():
-        try:
-            result = function(*args, **kwargs)
-        except BaseException as exc:
-            future.set_exception(exc)
+# does all of deploy_one_server's remote steps in a single exec:
+# $1 - remote dir, $2 - expected commit, $3 - whether to pull on mismatch (1/0),
+# $4 - patch on stdin: none, plain or gzip, or "file" to apply the already
+# uploaded patch $5;
+# prints "key=value" lines, see parse_deploy_status
+DEPLOY_SCRIPT = """\
+set -e
+cd "$1"
+commit=$(git rev-parse HEAD)
+git reset -q --hard
+if [ "$commit" != "$2" ] && [ "$3" = 1 ]; then
+    git pull -q
+    commit=$(git rev-parse HEAD)
+fi
+echo "commit=$commit"
+if [ "$commit" != "$2" ]; then
+    cat > /dev/null
+    echo "status=mismatch"
+elif [ "$4" = none ]; then
+    echo "status=reset"
+elif [ "$4" = gzip ]; then
+    gzip -d -c | git apply --index -
+    echo "status=applied"
+elif [ "$4" = file ]; then
+    git apply --index "$5"
+    echo "status=applied"
+else
+    git apply --index -
+    echo "status=applied"
+fi
+"""
+
+
+def deploy_one_server_pipelined(
+    app,
+    executor,
+    server,
+    local_commit_f,
+    patch_f,
+    compress=None,
+    patch_cache=None,
+    bundles=None,
+):
+    """
+    Same as deploy_one_server, but in one round trip: the remote script
+    gets the patch on its stdin and reports back what it has done.
+    Patches too big to resend each time go through patch_cache first.
+    With bundles, a server at another commit takes two more round trips:
+    to fetch the bundle and to run the script again.
+    """
+    server = app.maybe_resolve_host_alias(server)
+    log.info("Deploying to server %s in a single pass...", server)
+    ssh_conn = app.make_ssh_connection(server)
+    remote_path = ssh_conn.home_dir
+
+    with ssh_conn:
+        patch_contents: bytes = patch_f.result()
+        script_args = []
+        if not patch_contents:
+            patch_mode = "none"
+        elif patch_cache is not None and len(patch_contents) > PATCH_INLINE_MAX_SIZE:
+            patch_mode = "file"
+            script_args.append(
+                patch_cache.ensure_remote(ssh_conn, patch_contents, compress)
+            )
+            patch_contents = b""
         else:
-            future.set_result(result)
+            level = sshlib.resolve_compression_level(ssh_conn, compress, upload=True)
+            if level is None:
+                patch_mode = "plain"
+            else:
+                patch_mode = "gzip"
+                patch_contents = gzip.compress(patch_contents, level)
+        local_commit = local_commit_f.result()
+
+        def run_script(pull):
+            command = " ".join(
+                shlex.quote(arg)
+                for arg in ["sh", "-c", DEPLOY_SCRIPT, "aqx-deploy"]
+                + [remote_path, local_commit, "1" if pull else "0", patch_mode]
+                + script_args
+            )
+            return parse_deploy_status(ssh_conn.cmd_input(command, patch_contents))
+
+        status = run_script(pull=bundles is None)
+        if status["status"] == "mismatch" and bundles is not None:
+            _freshen(ssh_conn, remote_path, status["commit"], local_commit, bundles)
+            status = run_script(pull=False)
+    log.info("%s: Remote git hash: %s", server, status["commit"])
+    if status["status"] == "mismatch":
+        raise RevisionMismatchError
+    if status["status"] == "reset":
+        log.info(
+            "%s: no local changes to deploy with patch - just cancel remote changes",
+            server,
+        )
+    log.info("%s: done", server)
+
+
+def parse_deploy_status(output: bytes):
+    """
+    :return: dict of DEPLOY_SCRIPT's report, with at least "commit" and "status"
+    """
+    status = {}
+    for line in output.decode().splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            status[key] = value
+    if "commit" not in status or "status" not in status:
+        raise sshlib.SshCommandError(f"unexpected deploy script output: {output!r}")
+    return status
+
+
+def main(
+    app: core.AppService,
+    servers,
+    compress=None,
+    parallel=8,
+    batch_size=None,
+    waves=None,
+    max_failures=None,
+    pipelined=False,
+    use_patch_cache=True,
+    use_bundles=True,
+    relay_fanout=None,
+):
+    """
+    Deploys to servers in waves, each wave at most `parallel` servers at a time.
+    :param batch_size: servers per wave; alternatively `waves` - number of waves
+    :param max_failures: stop rolling out once more servers have failed
+    :param pipelined: do each server in one round trip, see DEPLOY_SCRIPT
+    :param use_patch_cache: keep patches on the servers, see PatchCache
+    :param use_bundles: update servers at other commits with git bundles
+        instead of git pull, see BundleBuilder
+    :param relay_fanout: send the patch to all servers' caches beforehand,
+        relaying it from server to server, see relay.relay_file
+    :return: exit code
+    """
+    patch_cache = PatchCache() if use_patch_cache else None
+    bundles = BundleBuilder(app.client.cwd) if use_bundles else None
+    deploy_fn = deploy_one_server_pipelined if pipelined else deploy_one_server
+    n_failed = 0
+    deployed = []
+    skipped = []
+
+    def is_aborted():
+        return max_failures is not None and n_failed > max_failures
+
+    # servers' side tasks (sending the patch) get their own threads, so they
+    # never wait for a free worker behind the servers that wait for them
+    aux_executor = ThreadPoolExecutor(max_workers=parallel + 2)
+    servers_executor = ThreadPoolExecutor(max_workers=parallel)
+    with aux_executor, servers_executor:
+        local_commit_f = _acall(aux_executor, get_local_git_commit, app.client.cwd)
+        patch_f = _acall(aux_executor, generate_patch, app.client.cwd)
+        # resolve all EC2 addresses at once rather than by each server's thread
+        hosts = app.get_hosts(servers)
+        if relay_fanout is not None and patch_cache is not None:
+            _seed_patch_caches(
+                app, servers_executor, hosts, patch_f, patch_cache, relay_fanout
+            )
+
+        for wave_no, wave in enumerate(_split_waves(servers, batch_size, waves), 1):
+            if is_aborted():
+                skipped += wave
+                continue
+            if batch_size is not None or waves is not None:
+                log.info("wave %d: %s", wave_no, ", ".join(wave))
+            deploy_fs = {
+                _acall(
+                    servers_executor,
+                    _deploy_unless_aborted,
+                    is_aborted,
+                    deploy_fn,
+                    app,
+                    aux_executor,
+                    server,
+                    local_commit_f,
+                    patch_f,
+                    compress,
+                    patch_cache,
+                    bundles,
+                ): server
+                for server in wave
+            }
+            for deploy_f in as_completed(deploy_fs):
+                server = deploy_fs[deploy_f]
+                try:
+                    if deploy_f.result():
+                        deployed.append(server)
+                    else:
+                        skipped.append(server)
+                except RevisionMismatchError:
+                    log.error("%s: Git versions do not match", server)
+                    n_failed += 1
+                except Exception:
+                    log.exception("%s: deploy failed", server)
+                    n_failed += 1
+
+    log.info(
+        "deployed: %d, failed: %d, skipped: %d", len(deployed), n_failed, len(skipped)
+    )
+    if skipped:
+        log.error("too many failures, not deployed to: %s", ", ".join(skipped))
+    return 1 if n_failed or skipped else 0
+
+
+def _seed_patch_caches(app, executor, hosts, patch_f, patch_cache, fanout):
+    patch_contents = patch_f.result()
+    if not patch_contents:
+        return
+    with contextlib.ExitStack() as stack:
+        connections = []
+        connect_fs = [
+            _acall(
+                executor,
+                lambda host: host.make_ssh_connection(pool=app.ssh_pool).__enter__(),
+                host,
+            )
+            for host in hosts
+        ]
+        for connect_f in connect_fs:
+            try:
+                connections.append(connect_f.result())
+                stack.push(connections[-1])
+            except Exception:
+                # the server fails later on its own, with a proper report
+                log.warning("could not connect to seed the patch", exc_info=True)
+        log.info("relaying the patch to %d servers...", len(connections))
+        errors = patch_cache.seed_remotes(
+            connections, patch_contents, fanout, session_slot=app.session_slot
+        )
+    n_failed = sum(error is not None for error in errors)
+    if n_failed:
+        log.warning("%d servers will get the patch directly", n_failed)
+
+
+def _deploy_unless_aborted(is_aborted, deploy_fn, app, *args):
+    """
+    :return: False if the rollout was aborted before this server's turn
+    """
+    if is_aborted():
+        return False
+    with app.session_slot():
+        # the rollout may have been aborted while waiting for the slot
+        if is_aborted():
+            return False
+        deploy_fn(app, *args)
+    return True
+
+
+def _split_waves(servers, batch_size=None, waves=None):
+    if batch_size is not None:
+        return [servers[i : i + batch_size] for i in range(0, len(servers), batch_size)]
+    if waves is not None:
+        n_waves = min(waves, len(servers))
+        bounds = [i * len(servers) // n_waves for i in range(n_waves + 1)]
+        return [servers[bounds[i] : bounds[i + 1]] for i in range(n_waves)]
+    return [servers]
 
-    threading.Thread(target=function_call_main).start()
 
-    return future
+def _acall(executor, function, *args, **kwargs):
+    return executor.submit(core.with_current_client(function), *args, **kwargs)
 
 
 class RevisionMismatchError(Exception):
@@ -0,0 +1,81 @@
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from aqx import core, sshlib
+
+
+log = logging.getLogger(__name__)
+
+
+def main(app: core.AppService, servers, command, parallel=32, timeout=None):
+    """
+    Runs the shell command on the servers, at most `parallel` at a time,
+    printing their output live with every line prefixed by the server name.
+    Ends with a summary of the servers grouped by exit code.
+    :param timeout: seconds the command may run on each server
+    :return: exit code, 0 if the command has succeeded everywhere
+    """
+    hosts = app.get_hosts(servers)
+    width = max(len(server) for server in servers) + 1
+    output_lock = threading.Lock()
+
+    def run_on_server(server, host):
+        if app.client.cancelled.is_set():
+            raise core.RequestCancelled
+
+        def printer(out):
+            def print_line(line: bytes):
+                text = line.decode(errors="replace")
+                if not text.endswith("\n"):
+                    text += "\n"
+                with output_lock:
+                    out.write(f"{server + ':':<{width}} {text}")
+                    out.flush()
+
+            return print_line
+
+        with app.session_slot(), host.make_ssh_connection(pool=app.ssh_pool) as ssh:
+            result = ssh.cmd_run(
+                command,
+                on_stdout=printer(app.client.stdout),
+                on_stderr=printer(app.client.stderr),
+                lines=True,
+                max_retained=0,
+                check=False,
+                timeout=timeout,
+            )
+        return result.exit_code
+
+    statuses = {}
+    with ThreadPoolExecutor(max_workers=min(parallel, len(servers))) as executor:
+        run_fs = {
+            executor.submit(
+                core.with_current_client(run_on_server), server, host
+            ): server
+            for server, host in zip(servers, hosts)
+        }
+        for run_f in as_completed(run_fs):
+            server = run_fs[run_f]
+            try:
+                statuses[server] = run_f.result()
+            except sshlib.CommandTimeout:
+                log.error("%s: timed out after %ss", server, timeout)
+                statuses[server] = "timeout"
+            except core.RequestCancelled:
+                raise
+            except Exception as exc:
+                log.error("%s: %s", server, exc)
+                statuses[server] = "error"
+
+    by_status = collections.defaultdict(list)
+    for server in servers:
+        by_status[statuses[server]].append(server)
+    # exit codes in ascending order, then timeouts and errors
+    for status in sorted(by_status, key=lambda s: (isinstance(s, str), s)):
+        label = f"exit {status}" if isinstance(status, int) else status
+        print(
+            f"{label}: {len(by_status[status])} - {', '.join(by_status[status])}",
+            file=app.client.stderr,
+        )
+    return 0 if set(by_status) == {0} else 1
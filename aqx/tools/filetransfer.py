@@ -1,38 +1,120 @@
 import os
-import tqdm
+import shlex
+import tarfile
+import tempfile
+import threading
+import contextlib
 from aqx import sshlib, core
 
 
 def main(
-    app: core.AppService, server, is_download, file1, file2, skip_existing, pattern
+    app: core.AppService,
+    server,
+    is_download,
+    file1,
+    file2,
+    skip_existing,
+    pattern,
+    jobs=1,
+    shards=1,
+    engine="sftp",
+    sync=False,
+    compress=None,
+    relay_to=(),
+    fanout=2,
 ):
+    if relay_to:
+        return relay_upload(
+            app, [server, *relay_to], app.client.path(file1), file2, fanout
+        )
+
     server = app.maybe_resolve_host_alias(server)
-    ssh_conn = app.get_host(server).make_ssh_connection()
+    ssh_conn = app.make_ssh_connection(server)
+
+    if is_download:
+        file2 = app.client.path(file2)
+    else:
+        file1 = app.client.path(file1)
 
     with ssh_conn:
-        run_filetransfer(ssh_conn, is_download, file1, file2, skip_existing, pattern)
+        run_filetransfer(
+            ssh_conn,
+            is_download,
+            file1,
+            file2,
+            skip_existing,
+            pattern,
+            jobs=jobs,
+            shards=shards,
+            engine=engine,
+            sync=sync,
+            compress=compress,
+            progress_file=app.client.stderr,
+        )
 
 
 def run_filetransfer(
-    ssh_conn: sshlib.SSH, is_download, file1, file2, skip_existing, pattern
+    ssh_conn: sshlib.SSH,
+    is_download,
+    file1,
+    file2,
+    skip_existing,
+    pattern,
+    jobs=1,
+    shards=1,
+    engine="sftp",
+    sync=False,
+    compress=None,
+    progress_file=None,
 ):
-    pb = None
-    last_filename = None
+    import tqdm
+
+    progress_bars = {}
+    lock = threading.Lock()
 
     remote_home_dir = ssh_conn.home_dir
 
     def callback(filename, n_done, n_total):
-        nonlocal pb, last_filename
-        if filename != last_filename:
-            if pb:
-                pb.close()
-            pb = tqdm.tqdm(desc=filename, unit="B", unit_scale=True, unit_divisor=1024)
-            last_filename = filename
-        pb.total = n_total
-        pb.n = n_done
-        pb.update(0)
+        with lock:
+            pb = progress_bars.get(filename)
+            if pb is None:
+                if jobs == 1:
+                    # sequential transfer: a new file means the previous one is done
+                    _close_progress_bars(progress_bars)
+                pb = tqdm.tqdm(
+                    desc=filename,
+                    unit="B",
+                    unit_scale=True,
+                    unit_divisor=1024,
+                    file=progress_file,
+                )
+                progress_bars[filename] = pb
+            pb.total = n_total
+            pb.n = n_done
+            pb.update(0)
+            if jobs > 1 and n_done >= n_total:
+                progress_bars.pop(filename).close()
 
-    if is_download:
+    if engine == "tar":
+        if is_download:
+            sshlib.download_tar(
+                ssh_conn,
+                os.path.join(remote_home_dir, file1),
+                file2,
+                callback,
+                skip_existing=skip_existing,
+                pattern=pattern,
+            )
+        else:
+            sshlib.upload_tar(
+                ssh_conn,
+                file1,
+                os.path.join(remote_home_dir, file2),
+                callback,
+                skip_existing=skip_existing,
+                pattern=pattern,
+            )
+    elif is_download:
         sshlib.download_file_or_directory(
             ssh_conn,
             os.path.join(remote_home_dir, file1),
@@ -40,11 +122,75 @@ def run_filetransfer(
             callback,
             skip_existing=skip_existing,
             pattern=pattern,
+            jobs=jobs,
+            shards=shards,
+            sync=sync,
+            compress=compress,
         )
     else:
         sshlib.upload_file_or_directory(
-            ssh_conn, file1, os.path.join(remote_home_dir, file2), callback
+            ssh_conn,
+            file1,
+            os.path.join(remote_home_dir, file2),
+            callback,
+            shards=shards,
+            sync=sync,
+            compress=compress,
         )
 
-    if pb:
+    _close_progress_bars(progress_bars)
+
+
+def _close_progress_bars(progress_bars):
+    for pb in progress_bars.values():
         pb.close()
+    progress_bars.clear()
+
+
+def relay_upload(app: core.AppService, servers, local_path, remote_path, fanout=2):
+    """
+    Uploads a file or directory to many servers at once, see relay.relay_file.
+    :return: exit code
+    """
+    from aqx import relay
+
+    hosts = app.get_hosts(servers)
+    with contextlib.ExitStack() as stack:
+        if os.path.isdir(local_path):
+            payload_f = stack.enter_context(tempfile.NamedTemporaryFile())
+            with tarfile.open(fileobj=payload_f, mode="w") as tar:
+                tar.add(local_path, arcname=".")
+            payload_f.flush()
+            payload_path = payload_f.name
+            install_script = 'mkdir -p {dest} && tar -x -f "$1" -C {dest}'
+        else:
+            payload_path = local_path
+            install_script = 'mkdir -p {dest_dir} && cp "$1" {dest}'
+
+        connections = [
+            stack.enter_context(host.make_ssh_connection(pool=app.ssh_pool))
+            for host in hosts
+        ]
+        install_commands = []
+        for ssh in connections:
+            dest = os.path.join(ssh.home_dir, remote_path)
+            install_commands.append(
+                install_script.format(
+                    dest=shlex.quote(dest),
+                    dest_dir=shlex.quote(os.path.dirname(dest) or "."),
+                )
+            )
+
+        def on_done(ssh, error):
+            status = "done" if error is None else f"failed: {error}"
+            print(f"{ssh}: {status}", file=app.client.stderr)
+
+        errors = relay.relay_file(
+            connections,
+            payload_path,
+            install_commands,
+            fanout,
+            callback=on_done,
+            session_slot=app.session_slot,
+        )
+    return 1 if any(errors) else 0
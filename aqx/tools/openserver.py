@@ -1,4 +1,3 @@
-import webbrowser
 from aqx import core
 
 
@@ -6,4 +5,4 @@ def main(app: core.AppService, server, port):
     server = app.maybe_resolve_host_alias(server)
     address = app.get_host(server).get_inet_address()
     url = f"http://{address}:{port}"
-    webbrowser.open(url)
+    app.client.browse_url(url)
@@ -1,9 +1,47 @@
 import os
+import hashlib
+import subprocess
 from aqx import core
+from aqx.protocol import RUNTIME_DIR
 
 
-def main(app: core.AppService, server):
+CONTROL_DIR = os.path.join(RUNTIME_DIR, "ssh")
+# seconds a master connection stays up after its last session has ended
+CONTROL_PERSIST = 600
+
+
+def main(app: core.AppService, server, multiplex=True):
+    """
+    :param multiplex: share one OpenSSH master connection among all sessions
+        to the host, so that only the first one does the handshake
+    """
     server = app.maybe_resolve_host_alias(server)
-    command = app.get_host(server).get_shh_connect_commandline()
-    print(command)
-    os.system(command)
+    host = app.get_host(server)
+    if multiplex:
+        control_path = _control_path(host)
+        command = host.get_shh_connect_commandline(
+            control_path, CONTROL_PERSIST, _is_master_running(control_path)
+        )
+    else:
+        command = host.get_shh_connect_commandline()
+    print(command, file=app.client.stdout)
+    app.client.execute(command)
+
+
+def _control_path(host):
+    # unix socket paths are short, and a changed config needs another master
+    key = repr((host.name, host.address, host.username, host.private_key_path))
+    os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+    return os.path.join(CONTROL_DIR, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+
+def _is_master_running(control_path):
+    if not os.path.exists(control_path):
+        return False
+    check = subprocess.run(
+        ["ssh", "-O", "check", "-o", f"ControlPath={control_path}", "aqx"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return check.returncode == 0
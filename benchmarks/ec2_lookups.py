@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Counts describe_instances calls made to resolve the addresses of N EC2 hosts
+the way deploy and exec do it: one prefetch for all of them, then a lookup
+per host. AWS is replaced by an in-process fake, nothing goes to the network.
+
+Run from the repository root:
+    python benchmarks/ec2_lookups.py [--hosts N]
+Exits with 1 unless the hosts are resolved with exactly one describe call.
+"""
+
+import argparse
+import configparser
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from aqx import awslib, hostlib  # noqa: E402
+
+
+class FakeEC2:
+    def __init__(self, n_hosts):
+        self.instances = [
+            {
+                "InstanceId": f"i-{i:08x}",
+                "Tags": [{"Key": "Name", "Value": f"web{i}"}],
+                "InstanceType": "t3.micro",
+                "State": {"Name": "running"},
+                "PublicIpAddress": f"10.0.{i // 256}.{i % 256}",
+            }
+            for i in range(n_hosts)
+        ]
+        self.describe_calls = []
+
+    def get_paginator(self, operation):
+        assert operation == "describe_instances"
+        return self
+
+    def paginate(self, Filters=None, **kwargs):
+        self.describe_calls.append(Filters)
+        selected = [inst for inst in self.instances if _matches(inst, Filters)]
+        yield {"Reservations": [{"Instances": selected}]}
+
+
+def _matches(inst, filters):
+    for flt in filters or ():
+        if flt["Name"] == "instance-id":
+            value = inst["InstanceId"]
+        elif flt["Name"] == "tag:Name":
+            value = inst["Tags"][0]["Value"]
+        else:
+            raise ValueError(flt["Name"])
+        if value not in flt["Values"]:
+            return False
+    return True
+
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--hosts", "-n", type=int, default=50)
+    opts = cli.parse_args()
+
+    cp = configparser.ConfigParser()
+    cp["aws.access"] = dict(
+        access_token="bench", secret_token="bench", region="bench-1"
+    )
+    for i in range(opts.hosts):
+        cp[f"server.aws.web{i}"] = dict(
+            user="bench", home_dir="/home/bench", private_key_path="/dev/null"
+        )
+    hosts = [
+        hostlib.Host.from_configparser(cp, f"aws.web{i}") for i in range(opts.hosts)
+    ]
+
+    fake = FakeEC2(opts.hosts)
+    with tempfile.TemporaryDirectory() as work_dir:
+        options = hosts[0].aws_options
+        awslib._shared_ec2_instances[awslib.dataclasses.astuple(options)] = (
+            awslib.EC2Instances(
+                api=fake,
+                options=options,
+                cache=awslib.InventoryCache(
+                    os.path.join(work_dir, "inventory.json"), options.inventory_ttl
+                ),
+            )
+        )
+        started = time.perf_counter()
+        hostlib.prefetch_addresses(hosts)
+        addresses = [host.get_inet_address() for host in hosts]
+        elapsed = time.perf_counter() - started
+
+    assert addresses == [inst["PublicIpAddress"] for inst in fake.instances]
+    n_calls = len(fake.describe_calls)
+    print(
+        f"{opts.hosts} hosts resolved with {n_calls} describe calls "
+        f"in {elapsed * 1000:.0f} ms"
+    )
+    if n_calls != 1:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""
+Measures startup time of the aqx-* entry points and checks it against budgets.
+
+For every tool it reports:
+  import  - time to import the entry point and the tool module, in-process
+  output  - time from process start to the first byte of output
+            (the command line for ssh, usage text for the others)
+  exit    - time until the process exits
+and the heavy modules (paramiko, boto3, tqdm) that got imported on the way.
+
+Run from the repository root:
+    python benchmarks/startup.py [--repeat N] [--tool NAME ...]
+Exits with 1 when a median is over its budget.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import textwrap
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ["paramiko", "boto3", "tqdm"]
+
+CONFIG = """\
+[server]
+default = bench
+
+[server.bench]
+ssh_address = 127.0.0.1
+ssh_user = bench
+home_dir = /home/bench
+private_key_path = /dev/null
+"""
+
+# milliseconds, medians; output and exit are counted over the bare
+# interpreter startup
+BUDGETS = {
+    "ssh": dict(import_=100, output=120, exit_=150),
+    "openserver": dict(import_=100, output=None, exit_=200),
+    "filetransfer": dict(import_=400, output=150, exit_=200),
+    "deploy": dict(import_=400, output=150, exit_=200),
+    "exec": dict(import_=400, output=150, exit_=200),
+}
+
+TOOL_ARGS = {
+    "ssh": ["bench"],
+    "openserver": ["bench", "8080"],
+    "filetransfer": ["--help"],
+    "deploy": ["--help"],
+    "exec": ["--help"],
+}
+
+# tools whose module under aqx.tools is named otherwise
+TOOL_MODULES = {"exec": "execute"}
+
+
+def main():
+    cli = argparse.ArgumentParser()
+    cli.add_argument("--repeat", "-n", type=int, default=10)
+    cli.add_argument("--tool", action="append", choices=sorted(BUDGETS))
+    opts = cli.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        env = _make_env(work_dir)
+        baseline = _median(
+            _run([sys.executable, "-c", "pass"], work_dir, env)["exit_"]
+            for _ in range(opts.repeat)
+        )
+        print(f"interpreter startup: {baseline:.0f} ms, not included below")
+        over_budget = []
+        for tool in opts.tool or sorted(BUDGETS):
+            import_times = [
+                _measure_import(tool, work_dir, env) for _ in range(opts.repeat)
+            ]
+            runs = [
+                _run(_entry_point_cmd(tool), work_dir, env) for _ in range(opts.repeat)
+            ]
+            result = dict(
+                import_=_median(t for t, _ in import_times),
+                output=_median(r["output"] for r in runs if r["output"] is not None),
+                exit_=_median(r["exit_"] for r in runs),
+            )
+            if result["output"] is not None:
+                result["output"] -= baseline
+            result["exit_"] -= baseline
+            heavy = import_times[0][1]
+
+            cells = []
+            for metric, value in result.items():
+                budget = BUDGETS[tool][metric]
+                if value is None:
+                    cells.append(f"{metric.rstrip('_')} -")
+                    continue
+                mark = ""
+                if budget is not None and value > budget:
+                    mark = f" (over {budget})"
+                    over_budget.append(f"{tool} {metric.rstrip('_')}")
+                cells.append(f"{metric.rstrip('_')} {value:.0f} ms{mark}")
+            print(
+                f"{tool:<13} "
+                + ", ".join(cells)
+                + f"; heavy imports: {', '.join(heavy) or 'none'}"
+            )
+
+    if over_budget:
+        print("over budget: " + ", ".join(over_budget))
+        sys.exit(1)
+
+
+def _make_env(work_dir):
+    with open(os.path.join(work_dir, ".aqx.ini"), "w") as f:
+        f.write(CONFIG)
+    # the ssh tool runs the command line it prints, make that a no-op
+    bin_dir = os.path.join(work_dir, "bin")
+    os.mkdir(bin_dir)
+    fake_ssh = os.path.join(bin_dir, "ssh")
+    with open(fake_ssh, "w") as f:
+        f.write("#!/bin/sh\nexit 0\n")
+    os.chmod(fake_ssh, 0o755)
+
+    env = dict(os.environ)
+    env["PATH"] = bin_dir + os.pathsep + env.get("PATH", "")
+    env["PYTHONPATH"] = REPO_DIR + os.pathsep + env.get("PYTHONPATH", "")
+    env["BROWSER"] = "true"
+    return env
+
+
+def _entry_point_cmd(tool):
+    return [
+        sys.executable,
+        "-c",
+        f"from aqx.main_local import main_{tool}; main_{tool}()",
+        *TOOL_ARGS[tool],
+    ]
+
+
+def _measure_import(tool, work_dir, env):
+    module = TOOL_MODULES.get(tool, tool)
+    code = textwrap.dedent(f"""
+        import sys, time
+        started = time.perf_counter()
+        import aqx.main_local, aqx.tools.{module}
+        elapsed = time.perf_counter() - started
+        heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+        print(elapsed, *heavy)
+        """)
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=work_dir,
+        env=env,
+        check=True,
+        stdout=subprocess.PIPE,
+    ).stdout.decode()
+    elapsed, *heavy = out.split()
+    return float(elapsed) * 1000, heavy
+
+
+def _run(cmd, work_dir, env):
+    """
+    :return: dict of milliseconds to the first output byte and to the exit
+    """
+    started = time.perf_counter()
+    proc = subprocess.Popen(
+        cmd,
+        cwd=work_dir,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    first_byte = proc.stdout.read(1)
+    output_time = time.perf_counter() if first_byte else None
+    proc.stdout.read()
+    proc.wait()
+    exit_time = time.perf_counter()
+    return dict(
+        output=(output_time - started) * 1000 if output_time else None,
+        exit_=(exit_time - started) * 1000,
+    )
+
+
+def _median(values):
+    values = list(values)
+    return statistics.median(values) if values else None
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,11 @@ setup(
     python_requires=">=3.6.0",
     entry_points={"console_scripts": [
         "aqx-deploy=aqx.main_local:main_deploy",
+        "aqx-exec=aqx.main_local:main_exec",
         "aqx-filetransfer=aqx.main_local:main_filetransfer",
         "aqx-openserver=aqx.main_local:main_openserver",
         "aqx-ssh=aqx.main_local:main_ssh",
+        "aqx=aqx.main_clientserver:main",
+        "aqx-daemon=aqx.server_main:main",
     ]},
 )